@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import numpy as np
+import mne
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from mne.preprocessing import ICA
+from scipy.signal import butter, sosfiltfilt
+
+# Batch version of Demo.py: cleans every BrainVision recording of a directory with ICA
+# - each recording runs in its own worker process
+# - ICA is fitted on a decimated subset of the recording (evenly spaced chunks)
+# - the recording is then filtered (zero-phase as in Demo.py) and cleaned chunk by chunk,
+#   so memory does not grow with the file size, and written to <name>_clean.npy
+#   (samples x channels, volts) with a JSON sidecar <name>_clean.json (channels,
+#   sampling rate, ICA, cache key); <name>_clean.fif holds the same data for mne
+# - the outputs mirror the subdirectories of the input directory
+# - recordings whose output was made from the same content with the same settings are
+#   skipped (the sidecar keeps a hash of the source files)
+
+# Same channel types as in Demo.py
+channel_types = {'LHEOG': 'eog', 'RHEOG': 'eog', 'LMAST': 'misc', 'VEOG': 'eog', 'IZ': 'eeg'}
+
+def source_files(vhdr_file):
+    # header, marker and data file of a recording
+    stem = os.path.splitext(vhdr_file)[0]
+    return [vhdr_file] + [stem + ext for ext in ('.vmrk', '.eeg') if os.path.exists(stem + ext)]
+
+def file_stats(files):
+    return {os.path.basename(f): [os.path.getsize(f), os.stat(f).st_mtime_ns] for f in files}
+
+def content_hash(files, settings):
+    # hash of the source files and the settings that change the output
+    h = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+    for f in files:
+        with open(f, 'rb') as fid:
+            for block in iter(lambda: fid.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+def is_up_to_date(sidecar_file, output_file, files, settings):
+    # returns (up to date, hash), the hash is only computed if size or mtime changed
+    if not (os.path.exists(sidecar_file) and os.path.exists(output_file)):
+        return False, None
+    with open(sidecar_file) as fid:
+        sidecar = json.load(fid)
+    if sidecar.get('settings') != settings:
+        return False, None
+    if sidecar.get('sources') == file_stats(files):
+        return True, sidecar['hash']
+    # touched or copied: compare the content, keep the new stats if it did not change
+    digest = content_hash(files, settings)
+    if sidecar.get('hash') != digest:
+        return False, digest
+    sidecar['sources'] = file_stats(files)
+    write_json(sidecar_file, sidecar)
+    return True, digest
+
+def write_json(filename, data):
+    # replaced in one step, a crashed run never leaves a half written sidecar
+    with open(filename + '.tmp', 'w') as fid:
+        json.dump(data, fid, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+def chunk_starts(n_times, chunk, max_chunks):
+    # start samples of at most max_chunks evenly spaced chunks
+    starts = np.arange(0, n_times, chunk)
+    if len(starts) > max_chunks:
+        starts = starts[np.linspace(0, len(starts) - 1, max_chunks).astype(int)]
+    return starts
+
+def fit_ica(raw, sos, settings):
+    # ICA on a decimated subset: evenly spaced chunks filtered forward and backward
+    sfreq = raw.info['sfreq']
+    chunk = int(settings['chunk_seconds'] * sfreq)
+    decim = settings['decim'] or max(1, int(sfreq // (2.5 * settings['hfreq'])))
+    max_chunks = max(1, int(settings['fit_seconds'] * sfreq / chunk))
+    parts = list()
+    for start in chunk_starts(raw.n_times, chunk, max_chunks):
+        data = raw.get_data(start=start, stop=min(start + chunk, raw.n_times))
+        if data.shape[1] > 3 * 2 * len(sos):  # long enough for filtfilt
+            parts.append(sosfiltfilt(sos, data, axis=1)[:, ::decim])
+    info = mne.create_info(raw.ch_names, sfreq / decim, raw.get_channel_types())
+    subset = mne.io.RawArray(np.concatenate(parts, axis=1), info, verbose='error')
+    ica = ICA(n_components=settings['n_components'], random_state=97, max_iter='auto')
+    ica.fit(subset)
+    # flag the components that follow the EOG channels (Demo.py needed clicking for that)
+    if 'eog' in subset.get_channel_types():
+        ica.exclude, _ = ica.find_bads_eog(subset)
+    return ica, decim
+
+def filtered_chunks(raw, sos, chunk, pad):
+    # zero-phase filtering chunk by chunk: each chunk is filtered forward and backward
+    # together with pad samples of its neighbours, which take up the filter transients
+    # and are cut off again, so the result matches filtering the whole recording
+    for start in range(0, raw.n_times, chunk):
+        stop = min(start + chunk, raw.n_times)
+        first, last = max(0, start - pad), min(raw.n_times, stop + pad)
+        filtered = sosfiltfilt(sos, raw.get_data(start=first, stop=last), axis=1)
+        yield start, stop, filtered[:, start - first:stop - first]
+
+def write_fif(npy_file, fif_file, raw, chunk):
+    # the cleaned data is saved in pieces of chunk samples, which are joined without
+    # loading them (read_raw_fif(preload=False), concatenate_raws) into one file with
+    # the measurement date and annotations (markers) of the source recording
+    data = np.load(npy_file, mmap_mode='r')
+    info = mne.create_info(raw.ch_names, raw.info['sfreq'], raw.get_channel_types())
+    piece_dir = fif_file[:-4] + '.tmp'
+    os.makedirs(piece_dir, exist_ok=True)
+    try:
+        pieces = list()
+        for start in range(0, data.shape[0], chunk):
+            piece = mne.io.RawArray(np.array(data[start:start + chunk].T, dtype=np.float64), info, verbose='error')
+            pieces.append(os.path.join(piece_dir, 'piece%06d_raw.fif' % len(pieces)))
+            piece.save(pieces[-1], overwrite=True, verbose='error')
+        clean = mne.concatenate_raws([mne.io.read_raw_fif(f, preload=False, verbose='error') for f in pieces],
+                                     verbose='error')
+        clean.set_meas_date(raw.info['meas_date'])
+        clean.set_annotations(raw.annotations)  # replaces the boundaries between the pieces
+        clean.save(fif_file, overwrite=True, verbose='error')
+    finally:
+        shutil.rmtree(piece_dir, ignore_errors=True)
+
+def cleaning_matrix(ica, raw):
+    # ica.apply is linear up to the removed mean, so applying it to the identity (and a
+    # zero sample) gives clean = matrix @ data + offset for all channels at once
+    n = len(raw.ch_names)
+    info = mne.create_info(raw.ch_names, raw.info['sfreq'], raw.get_channel_types())
+    probe = mne.io.RawArray(np.hstack((np.eye(n), np.zeros((n, 1)))), info, verbose='error')
+    ica.apply(probe, verbose='error')
+    response = probe.get_data()
+    offset = response[:, n]
+    return response[:, :n] - offset[:, None], offset
+
+def clean_recording(vhdr_file, directory, output_dir, settings, force=False):
+    # worker process: returns a short summary of what was done
+    # sub01/run1.vhdr and sub02/run1.vhdr must not share their outputs
+    stem = os.path.join(output_dir, os.path.relpath(os.path.splitext(vhdr_file)[0], directory))
+    os.makedirs(os.path.dirname(stem), exist_ok=True)
+    output_file = stem + '_clean.npy'
+    fif_file = stem + '_clean.fif'
+    sidecar_file = stem + '_clean.json'
+    files = source_files(vhdr_file)
+    up_to_date, digest = (False, None) if force else is_up_to_date(sidecar_file, output_file, files, settings)
+    if up_to_date and settings['fif'] and not os.path.exists(fif_file):
+        up_to_date = False
+    if up_to_date:
+        return {'file': vhdr_file, 'status': 'up to date'}
+    t0 = time.time()
+    if digest is None:
+        digest = content_hash(files, settings)
+
+    raw = mne.io.read_raw_brainvision(vhdr_file, preload=False, verbose='error')
+    raw.set_channel_types({ch: kind for ch, kind in channel_types.items() if ch in raw.ch_names})
+    sfreq = raw.info['sfreq']
+    sos = butter(settings['order'], [settings['lfreq'], settings['hfreq']], btype='band', output='sos', fs=sfreq)
+    ica, decim = fit_ica(raw, sos, settings)
+    matrix, offset = cleaning_matrix(ica, raw)
+
+    # the outputs are incomplete until the new sidecar is written
+    if os.path.exists(sidecar_file):
+        os.remove(sidecar_file)
+    # streaming pass over overlapping chunks
+    chunk = int(settings['chunk_seconds'] * sfreq)
+    pad = int(settings['pad_seconds'] * sfreq)
+    tmp_file = output_file[:-4] + '.tmp.npy'
+    out = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(int(raw.n_times), len(raw.ch_names)))
+    for start, stop, filtered in filtered_chunks(raw, sos, chunk, pad):
+        out[start:stop, :] = (matrix @ filtered + offset[:, None]).T
+    out.flush()
+    del out
+    os.replace(tmp_file, output_file)
+    if settings['fif']:
+        write_fif(output_file, fif_file, raw, chunk)
+
+    # the sidecar is written last, it marks the output as complete
+    write_json(sidecar_file, {
+        'source': os.path.abspath(vhdr_file),
+        'sources': file_stats(files),
+        'hash': digest,
+        'settings': settings,
+        'layout': 'samples x channels',
+        'unit': 'V',
+        'dtype': 'float32',
+        'sfreq': sfreq,
+        'n_times': int(raw.n_times),
+        'ch_names': raw.ch_names,
+        'ch_types': raw.get_channel_types(),
+        'fit_decim': decim,
+        'excluded_components': [int(c) for c in ica.exclude],
+        'cleaning_matrix': matrix.tolist(),
+        'cleaning_offset': offset.tolist(),
+    })
+    return {'file': vhdr_file, 'status': 'cleaned', 'seconds': time.time() - t0,
+            'excluded': [int(c) for c in ica.exclude]}
+
+def find_recordings(directory):
+    recordings = list()
+    for root, _, files in os.walk(directory):
+        recordings += [os.path.join(root, f) for f in files if f.lower().endswith('.vhdr')]
+    return sorted(recordings)
+
+def main():
+    parser = argparse.ArgumentParser(description='Clean all BrainVision recordings of a directory with ICA')
+    parser.add_argument('directory', type=str, help='Directory with .vhdr recordings (searched recursively)')
+    parser.add_argument('-o', '--output', type=str, default='', help='Output directory (default: <directory>/cleaned)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('-n', '--n-components', type=int, default=20, help='Number of ICA components')
+    parser.add_argument('--lfreq', type=float, default=1.0, help='Highpass edge in Hz')
+    parser.add_argument('--hfreq', type=float, default=40.0, help='Lowpass edge in Hz')
+    parser.add_argument('--decim', type=int, default=0, help='Decimation of the ICA fit data (0: from hfreq)')
+    parser.add_argument('--fit-seconds', type=float, default=600.0, help='Max seconds of data used for the ICA fit')
+    parser.add_argument('--chunk-seconds', type=float, default=10.0, help='Seconds of data per chunk')
+    parser.add_argument('--pad-seconds', type=float, default=10.0,
+                        help='Seconds of neighbouring data filtered along with each chunk (about 10/lfreq)')
+    parser.add_argument('--no-fif', action='store_true', help='Only write the .npy output, no .fif file')
+    parser.add_argument('-f', '--force', action='store_true', help='Clean recordings that are up to date as well')
+    args = parser.parse_args()
+
+    output_dir = args.output or os.path.join(args.directory, 'cleaned')
+    os.makedirs(output_dir, exist_ok=True)
+    settings = {'n_components': args.n_components, 'lfreq': args.lfreq, 'hfreq': args.hfreq, 'order': 4,
+                'decim': args.decim, 'fit_seconds': args.fit_seconds, 'chunk_seconds': args.chunk_seconds,
+                'pad_seconds': args.pad_seconds, 'fif': not args.no_fif}
+    recordings = [f for f in find_recordings(args.directory) if not os.path.abspath(f).startswith(os.path.abspath(output_dir))]
+    print("Cleaning %d recordings with %d processes" % (len(recordings), args.jobs))
+    t0 = time.time()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        jobs = {pool.submit(clean_recording, f, args.directory, output_dir, settings, args.force): f for f in recordings}
+        for job in as_completed(jobs):
+            try:
+                result = job.result()
+            except Exception as e:
+                failed += 1
+                print("%s: failed (%s)" % (jobs[job], e))
+                continue
+            if result['status'] == 'cleaned':
+                print("%s: cleaned in %.1f s, removed components %s" % (result['file'], result['seconds'], result['excluded']))
+            else:
+                print("%s: %s" % (result['file'], result['status']))
+    print("Done in %.1f s, %d failed" % (time.time() - t0, failed))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
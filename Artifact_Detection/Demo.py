@@ -26,6 +26,71 @@ raw_clean.save(output_fif_file, overwrite=True)
 
 data_clean, times = raw_clean[:]
 
+class EnvelopePyramid:
+    # min/max of each channel over blocks of block, block*factor, block*factor**2, ... samples,
+    # computed once, such that any zoom level can be drawn with about two points per pixel
+    def __init__(self, times, data, block=16, factor=4):
+        self.times = times
+        self.data = data
+        self.levels = []  # (block size, min, max) from fine to coarse
+        size = block
+        lo, hi = block_minmax(data, data, block)
+        while True:
+            self.levels.append((size, lo, hi))
+            if lo.shape[1] <= factor:
+                break
+            lo, hi = block_minmax(lo, hi, factor)
+            size *= factor
+
+    def view(self, tmin, tmax, width):
+        # x and channels x points of the samples between tmin and tmax for width pixels
+        i0 = max(0, np.searchsorted(self.times, tmin) - 1)
+        i1 = min(len(self.times), np.searchsorted(self.times, tmax) + 1)
+        if i1 - i0 <= 2 * width:  # zoomed in far enough for the samples themselves
+            return self.times[i0:i1], self.data[:, i0:i1]
+        size, lo, hi = self.levels[-1]
+        for level in self.levels:
+            if (i1 - i0) / level[0] <= width:
+                size, lo, hi = level
+                break
+        b0, b1 = i0 // size, min(lo.shape[1], -(-i1 // size))
+        # down and up within each block
+        x = np.repeat(self.times[np.arange(b0, b1) * size], 2)
+        y = np.stack((lo[:, b0:b1], hi[:, b0:b1]), axis=2).reshape(lo.shape[0], -1)
+        return x, y
+
+def block_minmax(lo, hi, size):
+    # min of lo and max of hi over blocks of size samples (the last block may be shorter)
+    n = lo.shape[1] // size * size
+    rlo = lo[:, :n].reshape(lo.shape[0], -1, size).min(axis=2)
+    rhi = hi[:, :n].reshape(hi.shape[0], -1, size).max(axis=2)
+    if n < lo.shape[1]:
+        rlo = np.hstack((rlo, lo[:, n:].min(axis=1, keepdims=True)))
+        rhi = np.hstack((rhi, hi[:, n:].max(axis=1, keepdims=True)))
+    return rlo, rhi
+
+class EnvelopePlot:
+    # one line per channel that only holds the envelope of the visible part, it is
+    # refined (or coarsened) whenever the x limits change (zoom, pan, shared axes)
+    def __init__(self, ax, pyramid, labels, scale=1e6, spacing=100):
+        self.ax = ax
+        self.pyramid = pyramid
+        self.scale = scale
+        self.offsets = np.arange(len(labels)) * spacing  # Shift each channel for visibility
+        self.lines = [ax.plot([], [], label=label)[0] for label in labels]
+        ax.set_xlim(pyramid.times[0], pyramid.times[-1])
+        self.update(ax)
+        ax.relim()
+        ax.autoscale_view(scalex=False)
+        ax.callbacks.connect('xlim_changed', self.update)
+
+    def update(self, ax):
+        tmin, tmax = ax.get_xlim()
+        x, y = self.pyramid.view(tmin, tmax, max(1, int(ax.bbox.width)))
+        for i, line in enumerate(self.lines):
+            line.set_data(x, y[i] * self.scale + self.offsets[i])
+        ax.figure.canvas.draw_idle()
+
 class ArtifactDetector:
     def __init__(self, times, data_clean, raw_clean):
         self.times = times
@@ -34,8 +99,7 @@ class ArtifactDetector:
         self.artifact_times = []
 
         self.fig, self.ax = plt.subplots(figsize=(15, 10))
-        for i in range(data_clean.shape[0]):
-            self.ax.plot(times, data_clean[i] * 1e6 + i * 100, label=raw_clean.ch_names[i])  # Shift each channel for visibility
+        self.plot = EnvelopePlot(self.ax, EnvelopePyramid(times, data_clean), raw_clean.ch_names)
         self.ax.set_title('Cleaned EEG Data')
         self.ax.set_xlabel('Time (s)')
         self.ax.set_ylabel('Amplitude (µV)')
@@ -47,9 +111,13 @@ class ArtifactDetector:
         plt.show()
 
     def onclick(self, event):
+        # clicks of the zoom and pan tools are not artifacts
+        toolbar = self.fig.canvas.toolbar
+        if event.inaxes is not self.ax or (toolbar is not None and toolbar.mode):
+            return
         self.ax.axvline(x=event.xdata, color='r', linestyle='--')
         self.artifact_times.append(event.xdata)
-        self.fig.canvas.draw()
+        self.fig.canvas.draw_idle()
 
 detector = ArtifactDetector(times, data_clean, raw_clean)
 
@@ -63,15 +131,17 @@ def plot_comparison(raw, raw_clean):
 
     fig, axes = plt.subplots(2, 1, figsize=(15, 10), sharex=True)
 
-    for i in range(data_raw.shape[0]):
-        axes[0].plot(times, data_raw[i] * 1e6 + i * 100, label=raw.ch_names[i])
+    # shared x axes: zooming one of them refines both
+    # matplotlib only keeps weak references to the xlim_changed callbacks, the plots
+    # have to stay referenced (here and by the caller) while the window is open
+    plots = list()
+    plots.append(EnvelopePlot(axes[0], EnvelopePyramid(times, data_raw), raw.ch_names))
     axes[0].set_title('Raw EEG Data')
     axes[0].set_ylabel('Amplitude (µV)')
     axes[0].legend(loc='upper right')
     axes[0].grid(True)
 
-    for i in range(data_clean.shape[0]):
-        axes[1].plot(times, data_clean[i] * 1e6 + i * 100, label=raw_clean.ch_names[i])
+    plots.append(EnvelopePlot(axes[1], EnvelopePyramid(times, data_clean), raw_clean.ch_names))
     axes[1].set_title('Cleaned EEG Data')
     axes[1].set_xlabel('Time (s)')
     axes[1].set_ylabel('Amplitude (µV)')
@@ -81,5 +151,6 @@ def plot_comparison(raw, raw_clean):
     fig.tight_layout()
     plt.savefig('eeg_comparison_plot.png')
     plt.show()
+    return plots
 
-plot_comparison(raw, raw_clean)
+plots = plot_comparison(raw, raw_clean)
@@ -4,8 +4,9 @@ import matplotlib.animation as animation
 import paho.mqtt.client as mqtt
 import json
 import queue
+import threading
 import time
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, sosfilt, sosfilt_zi
 
 # MQTT broker address
 broker_address = "172.31.1.1"
@@ -16,9 +17,10 @@ topic_action_stop = "action/sampling/stop"
 
 # Global variables
 scale_to_uV = None
-data_queue = queue.Queue()
-raw_data_queue = queue.Queue()  # Queue to store raw data
+message_queue = queue.Queue()  # Messages as received, handled by the worker thread
+channel_labels = ["HR"]  # Channels to sample and plot
 window_size = 1000  # Adjust window size to show data over a period of time
+block_size = 50  # Samples per block of the min/max used for autoscaling
 colors = ['b', 'r']  # Colors for raw and filtered HR channel
 fs = 500.0  # Sampling frequency (Hz)
 
@@ -27,17 +29,59 @@ lowcut = 0.5  # Low cutoff frequency (Hz)
 highcut = 5.0  # High cutoff frequency (Hz)
 order = 6  # Filter order
 
+# Ring buffer between the worker thread and the plot: raw and filtered data of a
+# sample are stored together. The worker writes the samples first and then advances
+# frames_written; the plot only reads up to frames_written, so no lock is needed
+ring_size = 4 * window_size
+frames = np.zeros((2, len(channel_labels), ring_size))  # raw/filtered x channels x samples
+frames_written = 0  # Samples written by the worker
+frames_read = 0  # Samples taken by the plot
+
+def write_frames(raw, filtered):
+    global frames_written
+    raw = raw[:frames.shape[1]]  # Only the plotted channels
+    filtered = filtered[:frames.shape[1]]
+    n = min(raw.shape[1], ring_size)
+    pos = frames_written % ring_size
+    n1 = min(n, ring_size - pos)
+    frames[0, :, pos:pos + n1] = raw[:, :n1]
+    frames[1, :, pos:pos + n1] = filtered[:, :n1]
+    frames[0, :, :n - n1] = raw[:, n1:n]
+    frames[1, :, :n - n1] = filtered[:, n1:n]
+    frames_written += n  # Publish the samples only after they are written
+
+def read_frames():
+    # Raw and filtered data written since the last call (2 x channels x samples)
+    global frames_read
+    written = frames_written
+    # Samples older than the window are not shown anyway (and may be overwritten)
+    n = min(written - frames_read, window_size)
+    pos = (written - n) % ring_size
+    frames_read = written
+    if pos + n <= ring_size:
+        return frames[:, :, pos:pos + n]
+    return np.concatenate((frames[:, :, pos:], frames[:, :, :pos + n - ring_size]), axis=2)
+
 # Butterworth bandpass filter
 def butter_bandpass(lowcut, highcut, fs, order=6):
     nyquist = 0.5 * fs
     low = lowcut / nyquist
     high = highcut / nyquist
-    b, a = butter(order, [low, high], btype='band')
-    return b, a
-
-def bandpass_filter(data, lowcut, highcut, fs, order=6):
-    b, a = butter_bandpass(lowcut, highcut, fs, order=order)
-    y = lfilter(b, a, data, axis=1)
+    sos = butter(order, [low, high], btype='band', output='sos')
+    return sos
+
+# The filter is designed once and keeps its state from one message to the next,
+# so the messages are filtered as one continuous signal
+sos = butter_bandpass(lowcut, highcut, fs, order=order)
+filter_state = None  # sections x channels x 2, set with the first message
+
+def bandpass_filter(data):
+    # data is channels x samples
+    global filter_state
+    if filter_state is None or filter_state.shape[1] != data.shape[0]:
+        # start in steady state for the first sample to avoid the step response
+        filter_state = sosfilt_zi(sos)[:, None, :] * data[None, :, :1]
+    y, filter_state = sosfilt(sos, data, axis=1, zi=filter_state)
     return y
 
 # Function to handle MQTT connection
@@ -51,14 +95,24 @@ def on_connect(client, userdata, flags, rc):
         print("Failed to connect, return code %d\n", rc)
 
 def on_message(client, userdata, message):
-    if message.topic == topic_info:
-        handle_info_message(message.payload)
-    elif message.topic == topic_samples:
-        handle_samples_message(message.payload)
+    # runs in the network thread of paho, the work is done in handle_messages
+    message_queue.put((message.topic, message.payload))
+
+def handle_messages():
+    # worker thread: decode, filter and queue the data for the plot
+    while True:
+        item = message_queue.get()
+        if item is None:
+            break
+        topic, payload = item
+        if topic == topic_info:
+            handle_info_message(payload)
+        elif topic == topic_samples:
+            handle_samples_message(payload)
 
 def start_sampling(client):
     sampling_params = {
-        "channel_label": ["HR"],
+        "channel_label": channel_labels,
         "data_format": 0.0,
         "gain": 12.0,
         "impedance_interval": 0.0,
@@ -86,53 +140,67 @@ def handle_info_message(payload):
 def handle_samples_message(payload):
     global scale_to_uV
     if scale_to_uV is not None:
-        samples_data = np.frombuffer(payload, dtype=np.uint32)
-        start_sample = samples_data[0]
-        end_sample = samples_data[1]
-        num_samples = end_sample - start_sample
-        num_channels = (len(samples_data) - 2) // num_samples
-        eeg_signal = samples_data[2:].reshape((num_channels, num_samples))
+        # [start, end] as uint32, then the samples as int32 with the channels of a sample
+        # next to each other (as F1toLSLInterface reads them)
+        start_sample, end_sample = np.frombuffer(payload, dtype=np.uint32, count=2)
+        num_samples = int(end_sample) - int(start_sample)
+        samples = np.frombuffer(payload, dtype=np.int32, offset=8)
+        num_channels = len(samples) // num_samples
+        eeg_signal = samples.reshape((num_samples, num_channels)).T
         eeg_signal_uV = eeg_signal * scale_to_uV
 
-        # Add raw data to raw data queue
-        raw_data_queue.put(eeg_signal_uV[0])
+        # Apply Butterworth bandpass filter to all channels at once
+        eeg_signal_uV_filtered = bandpass_filter(eeg_signal_uV)
 
-        # Apply Butterworth bandpass filter
-        eeg_signal_uV_filtered = bandpass_filter(eeg_signal_uV[:1, :], lowcut, highcut, fs)
-
-        # Add filtered data to queue
-        data_queue.put(eeg_signal_uV_filtered[0])
+        # Hand raw and filtered data to the plot together
+        write_frames(eeg_signal_uV, eeg_signal_uV_filtered)
     else:
         print("Error: scale_to_uV is not defined.")
 
+def update_block_limits(limits, data, start, n):
+    # min and max of the blocks that contain the samples start ... start+n-1
+    for block in range(start // block_size, (start + n - 1) // block_size + 1):
+        values = data[:, block * block_size:(block + 1) * block_size]
+        limits[0, block] = values.min()
+        limits[1, block] = values.max()
+
 def update_plot(frame):
-    try:
-        while not raw_data_queue.empty() and not data_queue.empty():
-            raw_signal_uV = raw_data_queue.get_nowait()
-            filtered_signal_uV = data_queue.get_nowait()
-
-            # Shift the current data to the left and add new data to the end
-            raw_data[:, :-len(raw_signal_uV)] = raw_data[:, len(raw_signal_uV):]
-            raw_data[:, -len(raw_signal_uV):] = raw_signal_uV
-
-            filtered_data[:, :-len(filtered_signal_uV)] = filtered_data[:, len(filtered_signal_uV):]
-            filtered_data[:, -len(filtered_signal_uV):] = filtered_signal_uV
-
-            for i, line in enumerate(raw_lines):
-                line.set_ydata(raw_data[i])
-
-            for i, line in enumerate(filtered_lines):
-                line.set_ydata(filtered_data[i])
-
-            ax.set_xlim(t[0], t[-1])
-            ax.set_ylim(np.min(raw_data) - 50, np.max(raw_data) + 50)  # Dynamically adjust y-axis
-            ax2.set_xlim(t[0], t[-1])
-            ax2.set_ylim(np.min(filtered_data) - 50, np.max(filtered_data) + 50)  # Dynamically adjust y-axis
-    except queue.Empty:
-        pass
+    global write_pos
+    new_frames = read_frames()  # All new samples at once
+    n = new_frames.shape[2]
+    if n == 0:
+        return raw_lines + filtered_lines
+
+    # Write the new samples at the write position (the plot sweeps instead of scrolling)
+    start = write_pos
+    n1 = min(n, window_size - write_pos)
+    raw_data[:, start:start + n1] = new_frames[0, :, :n1]
+    filtered_data[:, start:start + n1] = new_frames[1, :, :n1]
+    raw_data[:, :n - n1] = new_frames[0, :, n1:]
+    filtered_data[:, :n - n1] = new_frames[1, :, n1:]
+    write_pos = (write_pos + n) % window_size
+
+    # Only the blocks that changed get new limits
+    for data, limits in ((raw_data, raw_limits), (filtered_data, filtered_limits)):
+        update_block_limits(limits, data, start, n1)
+        if n > n1:
+            update_block_limits(limits, data, 0, n - n1)
+
+    for i, line in enumerate(raw_lines):
+        line.set_ydata(raw_data[i])
+
+    for i, line in enumerate(filtered_lines):
+        line.set_ydata(filtered_data[i])
+
+    ax.set_xlim(t[0], t[-1])
+    ax.set_ylim(raw_limits[0].min() - 50, raw_limits[1].max() + 50)  # Dynamically adjust y-axis
+    ax2.set_xlim(t[0], t[-1])
+    ax2.set_ylim(filtered_limits[0].min() - 50, filtered_limits[1].max() + 50)  # Dynamically adjust y-axis
     return raw_lines + filtered_lines
 
-# Set up MQTT client
+# Set up the worker thread and the MQTT client
+worker = threading.Thread(target=handle_messages, daemon=True)
+worker.start()
 client = mqtt.Client(client_id="Client2")
 client.on_connect = on_connect
 client.on_message = on_message
@@ -142,10 +210,14 @@ client.loop_start()
 # Set up the plot
 fig, (ax, ax2) = plt.subplots(2, 1, figsize=(12, 12))
 t = np.arange(0, window_size) * (1 / fs)
-raw_data = np.zeros((1, window_size))
-filtered_data = np.zeros((1, window_size))
-raw_lines = [ax.plot(t, np.zeros(window_size), color=colors[0])[0]]
-filtered_lines = [ax2.plot(t, np.zeros(window_size), color=colors[1])[0]]
+raw_data = np.zeros((len(channel_labels), window_size))
+filtered_data = np.zeros((len(channel_labels), window_size))
+write_pos = 0  # Next sample of the plot window
+nblocks = (window_size + block_size - 1) // block_size
+raw_limits = np.zeros((2, nblocks))  # min and max of each block
+filtered_limits = np.zeros((2, nblocks))
+raw_lines = [ax.plot(t, raw_data[i], color=colors[0])[0] for i in range(len(channel_labels))]
+filtered_lines = [ax2.plot(t, filtered_data[i], color=colors[1])[0] for i in range(len(channel_labels))]
 
 # Initial y-axis limits
 ax.set_ylim(-100, 100)
@@ -166,3 +238,5 @@ plt.show()
 # Clean up on exit
 client.loop_stop()
 stop_sampling(client)
+message_queue.put(None)
+worker.join()
@@ -1,76 +1,121 @@
 import sys
-import pyautogui
-import keyboard
+import argparse
 import time
 import math
 import numpy
-from random import random as rand
 
 from pylsl import StreamInfo, StreamOutlet, local_clock
 
+# synthetic eeg for testing nfrun without an amplifier
+# each block is built at once from phase accumulators and sent with push_chunk,
+# such that high channel counts and sampling rates do not saturate a core
+# scenarios set the amplitudes of the three theta sinusoids for every block:
+#   mouse    - from the mouse position (as before, needs pyautogui)
+#   constant - fixed amplitudes, no gui needed (load tests, ci)
+#   ramp     - amplitudes rise and fall slowly, such that the feedback moves
+#   noise    - noise and line noise only
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Send a synthetic theta signal via lsl')
+    parser.add_argument('-n', '--nchan', type=int, default=8, help='Number of channels')
+    parser.add_argument('-s', '--srate', type=int, default=250, help='Sampling rate')
+    parser.add_argument('-b', '--blocksize', type=int, default=32, help='Samples per chunk')
+    parser.add_argument('-c', '--scenario', type=str, default='mouse', choices=['mouse','constant','ramp','noise'], help='How the theta amplitudes change')
+    parser.add_argument('-d', '--duration', type=float, default=0, help='Stop after this many sec (0 runs until ESC)')
+    parser.add_argument('--name', type=str, default='BioSemi', help='Name of the lsl stream')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the noise')
+    return parser.parse_args(argv)
+
+def escapekey():
+    # returns a function that tells whether ESC is pressed (always False without the keyboard module)
+    try:
+        import keyboard
+        keyboard.is_pressed(chr(27))
+        return lambda: keyboard.is_pressed(chr(27))
+    except Exception:
+        print("Stop with Ctrl+C (ESC needs the keyboard module).")
+        return lambda: False
+
+def amplitudes(scenario, t, screen=None):
+    # amplitudes of the f1, f2 and f3 sinusoids at time t (sec)
+    if scenario == 'mouse':
+        import pyautogui
+        width, height = screen
+        x, y = pyautogui.position()
+        return max(0,x/width), max(0,y/height), math.sqrt(x**2+y**2)/math.sqrt(width**2+height**2)
+    if scenario == 'constant':
+        return 0.5, 0.5, 0.5
+    if scenario == 'ramp':
+        a = 0.5 - 0.5*math.cos(2*math.pi*t/60) # one minute period
+        return a, a, a
+    return 0, 0, 0
+
 def main(argv):
-    srate = 250
-    nchan = 8
+    args = parse_args(argv)
+    srate = args.srate
+    nchan = args.nchan
+    blocksize = args.blocksize
 
     # make a new stream outlet
     print("Creating a new streaminfo...")
-    info = StreamInfo("BioSemi", "EEG", nchan, srate, "float32", "myuid34234")
+    info = StreamInfo(args.name, "EEG", nchan, srate, "float32", "myuid34234")
     print("Opening an outlet...")
         # next make an outlet
     outlet = StreamOutlet(info)
     print("Now transmitting data...")
 
-    width, height = pyautogui.size()
-
-    f1 = 6.0
-    f2 = 5.0
-    f3 = 4.0
+    screen = None
+    if args.scenario == 'mouse':
+        import pyautogui
+        screen = pyautogui.size()
+    escape = escapekey()
+    rng = numpy.random.default_rng(args.seed)
 
-    ch1 = 1
-    ch2 = 2
-    ch3 = 6
+    # theta frequencies with their channels (1-based, channels beyond nchan are left out)
+    # and the line noise on all channels
+    freqs = numpy.array([6.0, 5.0, 4.0, 50.0])
+    gains = numpy.array([50, 50, 25, 10], dtype=numpy.float32)
+    chans = [ch-1 for ch in (1, 2, 6)]
+    # phase of each frequency at the samples of a block relative to the start of the block
+    # (sample nsamp is at time (nsamp+1)/srate as before)
+    steps = 2*numpy.pi*numpy.outer(freqs, numpy.arange(1, blocksize+1))/srate
+    phase = numpy.zeros(len(freqs))
+    phaseadvance = 2*numpy.pi*freqs*blocksize/srate
+    block = numpy.zeros((blocksize, nchan), dtype=numpy.float32)
+    waves = numpy.zeros((len(freqs), blocksize), dtype=numpy.float32)
 
-    blocksize = 32
     startTime = local_clock()
     lastUpdate = math.floor(local_clock()-startTime)
     nsamp= 0
-    isRunning = True    
-    
-    sent_samples = 0
-    
+    isRunning = True
 
     while isRunning:
         timeStamp = local_clock()
-        if  timeStamp > startTime+(nsamp+blocksize)/srate:        
-            t1 = (nsamp+1)/srate
-            t2 = (nsamp+blocksize)/srate
-            timevec = numpy.linspace(t1,t2,blocksize)
-            #print(timevec)
-            x, y = pyautogui.position()
-            amp1 = max(0,x/width)
-            amp2 = max(0,y/height)
-            amp3 = math.sqrt(x**2+y**2)/math.sqrt(width**2+height**2)
-            for i in range(len(timevec)):
-                dat = 50*numpy.random.normal(0, 0.1, size=[nchan,1])+50
-                linenoise = numpy.sin(50*timevec[i]*2*numpy.pi) * 10
-                dat = dat + numpy.tile(linenoise,(nchan,1))
-                #dat = numpy.zeros(dat.shape) # remove the noise for degugging
-                sig1 = numpy.sin(f1*timevec[i]*2*numpy.pi)*amp1*50
-                sig2 = numpy.sin(f2*timevec[i]*2*numpy.pi)*amp2*50
-                sig3 = numpy.sin(f3*timevec[i]*2*numpy.pi)*amp3*25
-                
-                dat[ch1-1] += sig1 
-                dat[ch2-1] += sig2 
-                dat[ch3-1] += sig3
-                #dat[-1]=i # check integrity for degubbing
-                outlet.push_sample(dat)
+        if  timeStamp > startTime+(nsamp+blocksize)/srate:
+            amp = amplitudes(args.scenario, nsamp/srate, screen)
+            numpy.sin(phase[:,numpy.newaxis] + steps, out=waves, casting='same_kind')
+            waves[:3] *= numpy.array(amp, dtype=numpy.float32)[:,numpy.newaxis]
+            waves *= gains[:,numpy.newaxis]
+            # noise around 50 and line noise on all channels
+            rng.standard_normal(dtype=numpy.float32, out=block)
+            block *= 5
+            block += 50 + waves[3][:,numpy.newaxis]
+            for k in range(3):
+                if chans[k] < nchan:
+                    block[:,chans[k]] += waves[k]
+            # time stamp of the last sample of the block, the others follow from srate
+            outlet.push_chunk(block, startTime+(nsamp+blocksize)/srate)
+            # the accumulators stay in [0, 2pi), so the phase stays exact for long runs
+            phase = numpy.mod(phase + phaseadvance, 2*numpy.pi)
             nsamp += blocksize
             if math.floor(timeStamp-startTime)>=lastUpdate+10:
                 lastUpdate = math.floor(timeStamp -startTime)
                 print("%3d sec of data sent."%(math.floor(timeStamp-startTime)))
+            if args.duration > 0 and nsamp >= args.duration*srate:
+                isRunning = False
         else:
             time.sleep((startTime+(nsamp+blocksize)/srate)-timeStamp)
-            if keyboard.is_pressed(chr(27)): 
+            if escape():
                 isRunning = False
 if __name__ == "__main__":
-    main(sys.argv[1:])
\ No newline at end of file
+    main(sys.argv[1:])
@@ -1,38 +1,119 @@
-import socket
-import re
+import socket, select, struct
 import numpy as np
-from pylsl import StreamInlet, resolve_stream
+from pylsl import StreamInlet, resolve_stream, local_clock
 
 class udpfeedback:
+    # feedback packets: sequence number, send time (lsl clock), r, g, b and the feedback
+    # value (nan for plain colors), little endian, 19 bytes
+    packet = struct.Struct('<IdBBBf')
+    # reports of the display back to the run: sequence number, send time, receive time,
+    # time the frame was shown, dropped packets, out of order packets
+    report = struct.Struct('<IdddII')
 
     def __init__(self):
         self.UDP_IP="127.0.0.1"
         self.UDP_PORT = 1977
+        self.REPORT_PORT = 1978
+        self.seq = 0
+        self.reportsock = None
+        self.reports = list()
+        # receiving side
+        self.lastseq = -1
+        self.dropped = 0
+        self.outoforder = 0
+        self.recvbuffer = bytearray(64)
     def connect(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
     def int2bstr(self,number):
         numstr = str(number)
         return  numstr.encode("ASCII")
-    def sendcolor(self,color):
-        MESSAGE =   b"(" + self.int2bstr(color[0]) + \
-                    b"," + self.int2bstr(color[1]) + \
-                    b"," + self.int2bstr(color[2]) + b")"
-        self.sock.sendto(MESSAGE, (self.UDP_IP, self.UDP_PORT))
-    def sendfeedback(self,feedback):
+    def colorpacket(self,color,value:float=np.nan):
+        # next packet to send (also used with asyncio transports, see nfsession)
+        self.seq += 1
+        return udpfeedback.packet.pack(self.seq, local_clock(), int(color[0]), int(color[1]), int(color[2]), value)
+    def feedbackpacket(self,feedback):
         blueval = min(255, round(feedback * 255))
         blueval = max(blueval,0)
-        self.sendcolor([0,0,blueval])
+        return self.colorpacket([0,0,blueval],feedback)
+    def sendcolor(self,color,value:float=np.nan):
+        self.sock.sendto(self.colorpacket(color,value), (self.UDP_IP, self.UDP_PORT))
+    def sendfeedback(self,feedback):
+        self.sock.sendto(self.feedbackpacket(feedback), (self.UDP_IP, self.UDP_PORT))
+
+    # run side: reports of the display
+    def listenreports(self):
+        # the display reports when each packet was shown, keep them for the latency log
+        try:
+            self.reportsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.reportsock.bind((self.UDP_IP, self.REPORT_PORT))
+            self.reportsock.setblocking(False)
+        except OSError as e:
+            print(f"Error: {e}, display reports are not recorded")
+            self.reportsock = None
+    def readreports(self):
+        # takes all queued reports without waiting
+        while self.reportsock is not None:
+            try:
+                nbytes = self.reportsock.recv_into(self.recvbuffer)
+            except (BlockingIOError, socket.timeout):
+                break
+            self.addreport(self.recvbuffer[:nbytes])
+    def addreport(self,data):
+        if len(data) == udpfeedback.report.size:
+            self.reports.append(udpfeedback.report.unpack_from(data))
+    def reportdict(self):
+        # for scipy.io.savemat, latencies in sec
+        reports = np.array(self.reports).reshape((-1,6))
+        return {'displayseq':reports[:,0],
+                'displaytransport':reports[:,2]-reports[:,1], # send -> receive
+                'displayphoton':reports[:,3]-reports[:,2], # receive -> shown
+                'displaydropped':reports[-1,4] if len(reports)>0 else 0,
+                'displayoutoforder':reports[-1,5] if len(reports)>0 else 0}
+
+    # display side
     def bindListener(self):
         self.sock.bind((self.UDP_IP, self.UDP_PORT))
         self.sock.settimeout(0.5)
+    def wait(self,timeout:float):
+        # waits up to timeout for the next packet, returns whether one is queued
+        readable,_,_ = select.select([self.sock],[],[],timeout)
+        return len(readable)>0
+    def receivelatest(self):
+        # takes all queued packets without waiting and returns the newest one as
+        # (seq, sendtime, (r,g,b), value, receivetime) or None; counts lost and late packets
+        latest = None
+        self.sock.setblocking(False)
+        while True:
+            try:
+                nbytes = self.sock.recv_into(self.recvbuffer)
+            except (BlockingIOError, socket.timeout):
+                break
+            if nbytes != udpfeedback.packet.size:
+                continue
+            seq, sendtime, r, g, b, value = udpfeedback.packet.unpack_from(self.recvbuffer)
+            if seq == 1: # first packet of a new run
+                self.lastseq = 0
+                self.dropped = self.outoforder = 0
+            elif seq <= self.lastseq:
+                self.outoforder += 1
+                continue
+            if self.lastseq >= 0:
+                self.dropped += seq-self.lastseq-1
+            self.lastseq = seq
+            latest = (seq, sendtime, (r,g,b), value, local_clock())
+        self.sock.settimeout(0.5)
+        return latest
+    def sendreport(self,latest,shown:float):
+        # tells the run when the packet latest (from receivelatest) was shown
+        MESSAGE = udpfeedback.report.pack(latest[0], latest[1], latest[4], shown, self.dropped, self.outoforder)
+        self.sock.sendto(MESSAGE, (self.UDP_IP, self.REPORT_PORT))
     def recievemsg(self):
+        # waits for the next packet (up to 0.5 s) and returns its color
         values = tuple()
         try:
-            data = self.sock.recvfrom(16) # buffer size is 16 bytes
-            string = data[0].decode('utf-8')
-            match = re.match(r'\((\d+),(\d+),(\d+)\)', string) 
-            if match: 
-                values = tuple(map(int, match.groups())) 
+            nbytes = self.sock.recv_into(self.recvbuffer)
+            if nbytes == udpfeedback.packet.size:
+                values = tuple(udpfeedback.packet.unpack_from(self.recvbuffer)[2:5])
         except socket.timeout:
             pass
         finally:
@@ -41,12 +122,17 @@ class udpfeedback:
 
     def close(self):
         self.sock.close()
+        if self.reportsock is not None:
+            self.reportsock.close()
   
 class lslreader:
-    def __init__(self,chanlist):
+    def __init__(self,chanlist,maxchunk=1024,timeout=0.1):
         self.inlet = -1
         self.chanlist = chanlist
         self.neegchan = len(chanlist)
+        self.maxchunk = maxchunk # max number of samples per readinto
+        self.timeout = timeout # in sec, readinto waits this long for new samples
+        self.buffer = np.zeros((0,0))
     def connect(self):
         # Find and resolve EEG stream
         print("Looking for an EEG stream...")
@@ -55,7 +141,27 @@ class lslreader:
             print("No EEG stream found.")
             return -1
         self.inlet = StreamInlet(streams[0])
+        self.allocate()
         return 0
+    def allocate(self):
+        # destination of pull_chunk: samples x stream channels in the format of the stream
+        self.buffer = np.zeros((self.maxchunk,self.inlet.channel_count),dtype=np.dtype(self.inlet.value_type))
+    def readinto(self):
+        # waits up to self.timeout for samples and returns a channels x samples view of the
+        # preallocated buffer (only valid until the next call) and the lsl timestamps
+        try:
+            _, timestamps = self.inlet.pull_chunk(timeout=0.0, max_samples=self.maxchunk, dest_obj=self.buffer)
+            if len(timestamps)==0 and self.timeout>0:
+                # nothing queued: sleep in liblsl until the first sample arrives, then take the rest
+                _, timestamps = self.inlet.pull_chunk(timeout=self.timeout, max_samples=1, dest_obj=self.buffer)
+                if len(timestamps)>0 and self.maxchunk>1:
+                    _, rest = self.inlet.pull_chunk(timeout=0.0, max_samples=self.maxchunk-1, dest_obj=self.buffer[1:])
+                    timestamps = list(timestamps) + list(rest)
+            nsamp = len(timestamps)
+            return self.buffer[:nsamp,:self.neegchan].T, np.array(timestamps)
+        except Exception as e:
+            print(f"Error: {e}")
+            return np.zeros((0,0)), np.zeros(0)
     def readdata(self):
         try:
             chunk, timestamp = self.inlet.pull_chunk()
@@ -69,4 +175,18 @@ class lslreader:
                 return np.zeros((0,0))
         except Exception as e:
             print(f"Error: {e}")
-            return np.zeros((0,0))
\ No newline at end of file
+            return np.zeros((0,0))
+    def close(self):
+        if self.inlet != -1:
+            self.inlet.close_stream()
+
+def eegreader(prm, chanlist, srate=0):
+    # acquisition backend selected by prm.source, all have the interface of lslreader
+    if prm.source == "f1": # directly from the F1 amplifier via mqtt
+        import nfmqtt
+        return nfmqtt.f1reader(chanlist, prm.lslmaxchunk, prm.lsltimeout, prm.f1host, srate=srate or prm.srate)
+    if prm.source == "sim": # simulated eeg in this process (no lsl, no hardware)
+        import nfsim
+        return nfsim.simreader(chanlist, prm.lslmaxchunk, prm.lsltimeout, srate or prm.srate,
+                               prm.simscenario, prm.simseed, prm.simspeed)
+    return lslreader(chanlist, prm.lslmaxchunk, prm.lsltimeout)
\ No newline at end of file
@@ -1,5 +1,7 @@
 import numpy as np
-import os, time, glob
+import scipy.io
+import os, sys, time, glob, json, queue, threading
+from multiprocessing import shared_memory, resource_tracker
 
 class params:
     def __init__(self):
@@ -9,56 +11,589 @@ class params:
         self.nfrunlength = 5*60 # default run length in sec
         self.calibrunlength = 60 # default training run length in sec
         self.srate = 250 # default srate
+        self.filtermode = "causal" # causal (streaming), zerophase or window (refilter each window)
+        self.bufferlength = 0 # in sec, keeps only this much data in a ring buffer (0 keeps the whole run)
+        self.legacymat = False # also write the complete run as .mat file at the end (stalls the end of the run)
+        self.lsltimeout = 0.1 # in sec, max time to wait for new samples from lsl
+        self.lslmaxchunk = 1024 # max number of samples pulled at once
+        self.source = "lsl" # lsl, f1 (mqtt connection to the F1 amplifier, see nfmqtt) or sim (see nfsim)
+        self.simscenario = "clean" # signal and transport of the simulated data (nfsim.scenarios)
+        self.simseed = 0 # the same seed gives the same simulated data
+        self.simspeed = 1.0 # 1 delivers the simulated data in real time, 0 as fast as possible
+        self.f1host = "172.31.1.1" # mqtt broker of the F1
+        self.latencyport = 0 # udp port to publish the latency of each feedback event (0 disables)
+        self.tapname = "" # name of the shared memory tap for display processes ("" disables)
+        self.tapfiltered = False # also publish the filtered data (tapname_filtered)
+        self.taplength = 10 # in sec, data kept in the tap
 
 class rawdata:
-    def __init__(self,nchan,nsamp):
+    def __init__(self,nchan,nsamp,ringsamps=0):
+        # with ringsamps>0 only the last ringsamps samples are kept in memory (ring buffer)
+        # and nsamp may exceed what fits into memory; use spill() to keep a record on disk
         self.nchan = nchan
         self.nsamp = nsamp
         self.srate = 0 # in Hz will be set during execution
-        self.eegsignals = np.zeros((nchan,nsamp))
+        self.ringsamps = ringsamps
+        if ringsamps>0:
+            # each sample is stored twice, such that every window of up to
+            # ringsamps samples is a contiguous slice of the buffer
+            self.eegsignals = np.zeros((nchan,2*ringsamps))
+            self.timestamps = np.zeros(2*ringsamps)
+        else:
+            self.eegsignals = np.zeros((nchan,nsamp))
+            self.timestamps = np.zeros(nsamp) # lsl timestamp of each sample
         self.sampcount = 0
-    def adddata(self,data: np.array):
+        self.spillfile = None
+        self.spillname = ""
+        self.recorder = None
+    def adddata(self,data: np.array,timestamps: np.array=None):
         if len(data.shape)==2:
-            nsamp = data.shape[1]
-            nd = self.eegsignals.shape[1]
-            nsamp = min(nsamp,nd-self.sampcount)
-            if nsamp>0:                                           
-                self.eegsignals[:, range(self.sampcount,self.sampcount+nsamp)] = data[:,range(nsamp)]
+            nsamp = min(data.shape[1],self.nsamp-self.sampcount)
+            if nsamp>0:
+                if timestamps is None or len(timestamps)<nsamp:
+                    timestamps = np.zeros(nsamp)
+                if self.ringsamps>0:
+                    self.ringwrite(data[:,:nsamp],timestamps[:nsamp])
+                else:
+                    self.eegsignals[:, self.sampcount:self.sampcount+nsamp] = data[:,:nsamp]
+                    self.timestamps[self.sampcount:self.sampcount+nsamp] = timestamps[:nsamp]
+                if self.spillfile is not None:
+                    np.asarray(data[:,:nsamp].T,dtype=np.float64,order='C').tofile(self.spillfile)
+                if self.recorder is not None:
+                    self.recorder.addeeg(data[:,:nsamp],timestamps[:nsamp])
                 self.sampcount += nsamp 
+    def ringwrite(self,data: np.array,timestamps: np.array):
+        nsamp = data.shape[1]
+        skip = max(0,nsamp-self.ringsamps) # older samples would be overwritten anyway
+        data = data[:,skip:]
+        timestamps = timestamps[skip:]
+        nsamp -= skip
+        pos = (self.sampcount+skip) % self.ringsamps
+        n1 = min(nsamp,self.ringsamps-pos)
+        for offset in (0,self.ringsamps):
+            self.eegsignals[:, offset+pos:offset+pos+n1] = data[:,:n1]
+            self.eegsignals[:, offset:offset+nsamp-n1] = data[:,n1:]
+            self.timestamps[offset+pos:offset+pos+n1] = timestamps[:n1]
+            self.timestamps[offset:offset+nsamp-n1] = timestamps[n1:]
+    def bufferpos(self,startsamp:int,nsamp:int):
+        # position of sample startsamp in the buffer
+        if self.ringsamps>0:
+            if nsamp>self.ringsamps or startsamp+self.ringsamps<self.sampcount:
+                raise ValueError("samples %d to %d are no longer in the ring buffer" % (startsamp,startsamp+nsamp))
+            return startsamp % self.ringsamps
+        return startsamp
+    def window(self,startsamp:int,nsamp:int):
+        # view (no copy) of the samples startsamp ... startsamp+nsamp-1
+        pos = self.bufferpos(startsamp,nsamp)
+        return self.eegsignals[:, pos:pos+nsamp]
+    def timewindow(self,startsamp:int,nsamp:int):
+        # lsl timestamps of the samples startsamp ... startsamp+nsamp-1
+        pos = self.bufferpos(startsamp,nsamp)
+        return self.timestamps[pos:pos+nsamp]
+    def record(self,recorder):
+        # pass every new sample on to a sessionrecorder
+        self.recorder = recorder
+    def spill(self,filename:str):
+        # append every new sample to a binary file (float64, sample by sample)
+        self.spillname = filename
+        self.spillfile = open(filename,'wb')
+    def recorded(self):
+        # all recorded samples; from the spill file if the data did not fit into memory
+        if self.ringsamps==0:
+            return self.eegsignals[:, :self.sampcount] # the run may have been stopped early
+        if self.recorder is not None:
+            return self.recorder.eeg()
+        if self.spillfile is not None:
+            self.spillfile.flush()
+            return np.fromfile(self.spillname,dtype=np.float64).reshape((-1,self.nchan)).T
+        nkeep = min(self.sampcount,self.ringsamps)
+        return np.array(self.window(self.sampcount-nkeep,nkeep))
+    def close(self):
+        if self.spillfile is not None:
+            self.spillfile.close()
+            self.spillfile = None
+
+class shmring:
+    # ring buffer in a named shared memory segment with one writer and several readers
+    # as in rawdata each sample is stored twice, so every window is a contiguous view;
+    # readers registered at creation hold back the writer (backpressure), other
+    # processes may attach and look at the most recent data without slowing it down
+    headerlen = 8 # nchan, ringsamps, nreaders, writecount, closed (2: error), nsamp, srate, reserved
+    def __init__(self,name:str,nchan:int=0,ringsamps:int=0,nreaders:int=0,nsamp:int=0,srate:int=0,
+                 create:bool=False,readonly:bool=False):
+        # readonly is for viewers started independently of the writer (e.g. nfshowsignals)
+        self.name = name
+        self.readonly = readonly
+        if create:
+            nvalues = shmring.headerlen + nreaders + 2*ringsamps*(nchan+1)
+            self.shm = shared_memory.SharedMemory(name=name,create=True,size=nvalues*8)
+            header = np.ndarray((shmring.headerlen,),dtype=np.int64,buffer=self.shm.buf)
+            header[:] = (nchan,ringsamps,nreaders,0,0,nsamp,srate,0)
+        elif readonly and sys.version_info >= (3,13):
+            self.shm = shared_memory.SharedMemory(name=name,track=False)
+            header = np.ndarray((shmring.headerlen,),dtype=np.int64,buffer=self.shm.buf)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            if readonly and os.name=='posix':
+                # otherwise the resource tracker of this process removes the segment at exit
+                resource_tracker.unregister(self.shm._name,'shared_memory')
+            header = np.ndarray((shmring.headerlen,),dtype=np.int64,buffer=self.shm.buf)
+        self.header = header
+        self.nchan, self.ringsamps, self.nreaders = [int(v) for v in header[:3]]
+        self.nsamp = int(header[5])
+        self.srate = int(header[6])
+        offset = shmring.headerlen*8
+        self.readcount = np.ndarray((self.nreaders,),dtype=np.int64,buffer=self.shm.buf,offset=offset)
+        offset += self.nreaders*8
+        self.timestamps = np.ndarray((2*self.ringsamps,),dtype=np.float64,buffer=self.shm.buf,offset=offset)
+        offset += 2*self.ringsamps*8
+        self.eegsignals = np.ndarray((self.nchan,2*self.ringsamps),dtype=np.float64,buffer=self.shm.buf,offset=offset)
+        if readonly:
+            for values in (self.header,self.readcount,self.timestamps,self.eegsignals):
+                values.flags.writeable = False
+
+    @property
+    def sampcount(self):
+        # number of samples written so far, also serves as sequence counter
+        return int(self.header[3])
+    @property
+    def closed(self):
+        return self.header[4]!=0
+    @property
+    def failed(self):
+        # closed because a stage died, the data ends early
+        return self.header[4]==2
+
+    def free(self):
+        # number of samples that can be written without overwriting unread data
+        if self.nreaders==0:
+            return self.ringsamps
+        return self.ringsamps-(self.sampcount-int(np.min(self.readcount)))
+
+    def write(self,data:np.array,timestamps:np.array=None,timeout:float=1.0):
+        # waits up to timeout for the readers to catch up, returns the number of samples written
+        nsamp = min(data.shape[1],self.nsamp-self.sampcount) if self.nsamp>0 else data.shape[1]
+        nsamp = min(nsamp,self.ringsamps)
+        endtime = time.time()+timeout
+        while self.free()<nsamp and time.time()<endtime:
+            time.sleep(0.001)
+        nsamp = min(nsamp,self.free())
+        if nsamp<=0:
+            return 0
+        if timestamps is None or len(timestamps)<nsamp:
+            timestamps = np.zeros(nsamp)
+        pos = self.sampcount % self.ringsamps
+        n1 = min(nsamp,self.ringsamps-pos)
+        for offset in (0,self.ringsamps):
+            self.eegsignals[:, offset+pos:offset+pos+n1] = data[:,:n1]
+            self.eegsignals[:, offset:offset+nsamp-n1] = data[:,n1:nsamp]
+            self.timestamps[offset+pos:offset+pos+n1] = timestamps[:n1]
+            self.timestamps[offset:offset+nsamp-n1] = timestamps[n1:nsamp]
+        self.header[3] += nsamp # publish the samples only after they are written
+        return nsamp
+
+    def bufferpos(self,startsamp:int,nsamp:int):
+        if nsamp>self.ringsamps or startsamp+self.ringsamps<self.sampcount:
+            raise ValueError("samples %d to %d are no longer in the ring buffer" % (startsamp,startsamp+nsamp))
+        return startsamp % self.ringsamps
+    def window(self,startsamp:int,nsamp:int):
+        pos = self.bufferpos(startsamp,nsamp)
+        return self.eegsignals[:, pos:pos+nsamp]
+    def timewindow(self,startsamp:int,nsamp:int):
+        pos = self.bufferpos(startsamp,nsamp)
+        return self.timestamps[pos:pos+nsamp]
+
+    def unread(self,reader:int):
+        # position and number of samples not yet consumed by a registered reader
+        start = int(self.readcount[reader])
+        return start, self.sampcount-start
+    def release(self,reader:int,nsamp:int):
+        # the reader is done with the next nsamp samples
+        self.readcount[reader] += nsamp
+
+    def finish(self,error:bool=False):
+        # tells the readers that no more data will arrive
+        self.header[4] = 2 if error else 1
+    def close(self):
+        # views into the segment have to be released before it can be closed
+        self.header = self.readcount = self.timestamps = self.eegsignals = None
+        self.shm.close()
+    def unlink(self):
+        self.shm.unlink()
+
+    def latest(self,since:int,maxsamps:int=0):
+        # for viewers: position and view of the samples written after sample since,
+        # limited to the last maxsamps samples (and to what is still in the ring)
+        count = self.sampcount
+        start = max(since,count-self.ringsamps+1)
+        if maxsamps>0:
+            start = max(start,count-maxsamps)
+        return start, self.window(start,count-start)
+
+class shmtap:
+    # publishes the acquired data in shared memory for display processes, so they
+    # do not need an lsl inlet of their own (nfshowsignals --shm name)
+    # the raw data go to ring name, the data after filters (nfprocess.filterbank) to name_filtered
+    # the rings have no registered readers, the viewers never hold back acquisition
+    def __init__(self,name:str,nchan:int,srate:int,ringsamps:int,filters=None):
+        self.filters = filters
+        self.raw = shmtap.createring(name,nchan,ringsamps,srate)
+        self.filtered = None
+        if filters is not None:
+            self.filtered = shmtap.createring(name+"_filtered",nchan,ringsamps,srate)
+
+    def createring(name:str,nchan:int,ringsamps:int,srate:int):
+        try:
+            return shmring(name,nchan,ringsamps,0,0,srate,create=True)
+        except FileExistsError: # left over from a run that did not finish
+            ring = shmring(name)
+            ring.close()
+            ring.unlink()
+            return shmring(name,nchan,ringsamps,0,0,srate,create=True)
+
+    def write(self,data:np.array,timestamps:np.array=None):
+        shmtap.writeall(self.raw,data,timestamps)
+        if self.filtered is not None:
+            shmtap.writeall(self.filtered,self.filters.filter(data),timestamps)
+
+    def writeall(ring:shmring,data:np.array,timestamps:np.array=None):
+        # a chunk larger than the ring is written in ring-sized pieces, such that the sample count
+        # stays the number of acquired samples (the viewers only see the last piece)
+        pos = 0
+        while pos<data.shape[1]:
+            nsamp = ring.write(data[:,pos:],None if timestamps is None else timestamps[pos:],0)
+            if nsamp==0:
+                break
+            pos += nsamp
+
+    def close(self):
+        for ring in (self.raw,self.filtered):
+            if ring is not None:
+                ring.finish()
+                ring.close()
+                ring.unlink()
 
 class fbdata:
-    def __init__(self):
-        self.position = list()
-        self.amplitude = list()
-        self.feedbackvalue = list()
-        self.loweredge = list()
-        self.upperedge = list()
-        self.timestamp = list()
-        self.preprocdata = list()
+    # outcome of the feedback events, one record per event in a preallocated table
+    # that doubles its size when full; the columns are views of the table (no copy)
+    __slots__ = ('table','count','preproc')
+    dtype = np.dtype([('position',np.int64),('amplitude',np.float64),('feedbackvalue',np.float64),
+                      ('loweredge',np.float64),('upperedge',np.float64),('timestamp',np.float64)])
+
+    def __init__(self,nevents:int=256):
+        # nevents is the expected number of events, e.g. run length / fbrefresh
+        self.table = np.zeros(max(1,nevents),dtype=fbdata.dtype)
+        self.count = 0
+        self.preproc = None # events x samples, allocated with the first signal
 
     def adddata(self,position:int,amplitude:float,feedbackvalue:float,lowedge:float,upedge:float,tstamp:float):
-        self.position.append(position)
-        self.amplitude.append(amplitude)
-        self.feedbackvalue.append(feedbackvalue)
-        self.loweredge.append(lowedge)
-        self.upperedge.append(upedge)
-        self.timestamp.append(tstamp)
+        if self.count == len(self.table):
+            self.table = np.concatenate((self.table,np.zeros(len(self.table),dtype=fbdata.dtype)))
+        self.table[self.count] = (position,amplitude,feedbackvalue,lowedge,upedge,tstamp)
+        self.count += 1
     def addpreprocdata(self,signal:np.array):
-        self.preprocdata.append(signal)
+        # signal may be a reused buffer, it is copied into the table
+        signal = np.ravel(signal)
+        if self.preproc is None:
+            self.preproc = np.zeros((len(self.table),len(signal)))
+        elif self.count > len(self.preproc):
+            self.preproc = np.concatenate((self.preproc,np.zeros((len(self.table)-len(self.preproc),len(signal)))))
+        self.preproc[self.count-1,:] = signal
+
+    def events(self):
+        # the recorded events as structured array (view)
+        return self.table[:self.count]
+    @property
+    def position(self):
+        return self.table['position'][:self.count]
+    @property
+    def amplitude(self):
+        return self.table['amplitude'][:self.count]
+    @property
+    def feedbackvalue(self):
+        return self.table['feedbackvalue'][:self.count]
+    @property
+    def loweredge(self):
+        return self.table['loweredge'][:self.count]
+    @property
+    def upperedge(self):
+        return self.table['upperedge'][:self.count]
+    @property
+    def timestamp(self):
+        return self.table['timestamp'][:self.count]
+    @property
+    def preprocdata(self):
+        if self.preproc is None:
+            return np.zeros((0,0))
+        return self.preproc[:self.count]
+
+class sessionrecorder:
+    # append-only recording of a run, written by a background thread while the run goes on
+    # the recording is a directory with flat binary files that can be memory-mapped:
+    #   eeg.bin         float64, samples x channels
+    #   timestamps.bin  float64, lsl timestamp of each sample
+    #   chunks.bin      index of the written chunks (first sample, nsamp, first timestamp)
+    #   events.bin      feedback events (sessionrecorder.eventdtype)
+    #   index.json      channels, srate, counts and state ('recording' or 'finalized')
+    eventdtype = fbdata.dtype
+    chunkdtype = np.dtype([('firstsample',np.int64),('nsamp',np.int64),('timestamp',np.float64)])
+
+    def __init__(self,path:str,chanlist:list,srate:float,maxqueue:int=1000):
+        self.path = path
+        os.makedirs(path,exist_ok=True)
+        self.chanlist = list(chanlist)
+        self.nchan = len(chanlist)
+        self.srate = srate
+        self.nsamp = 0 # samples handed to the recorder
+        self.nevents = 0 # events handed to the recorder
+        self.written = [0,0] # samples and events on disk
+        self.files = {name:open(os.path.join(path,name+'.bin'),'wb') for name in ['eeg','timestamps','chunks','events']}
+        self.queue = queue.Queue(maxqueue) # bounded, the run waits if the disk cannot keep up
+        self.error = None # first error of the writer, the recording stops there
+        self.writeindex('recording')
+        self.writer = threading.Thread(target=self.writeloop,daemon=True)
+        self.writer.start()
+
+    def addeeg(self,data:np.array,timestamps:np.array=None):
+        # data is channels x samples; it is copied before it is queued, because readers hand
+        # out views of buffers that they overwrite with the next chunk
+        nsamp = data.shape[1]
+        if nsamp==0 or self.error is not None:
+            return
+        if timestamps is None:
+            timestamps = np.zeros(nsamp)
+        chunk = np.array([(self.nsamp,nsamp,timestamps[0])],dtype=sessionrecorder.chunkdtype)
+        self.queue.put(('eeg',np.array(data.T,dtype=np.float64,order='C',copy=True),np.array(timestamps[:nsamp],dtype=np.float64,copy=True),chunk))
+        self.nsamp += nsamp
+
+    def addevents(self,outcome):
+        # writes the events of the outcome (fbdata) that were not recorded yet
+        nevents = outcome.count
+        if nevents<=self.nevents or self.error is not None:
+            return
+        # written events do not change, so a view of the table is enough
+        self.queue.put(('events',outcome.events()[self.nevents:nevents]))
+        self.nevents = nevents
+
+    def writeloop(self):
+        lastindex = time.time()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            # after an error the items are only taken from the queue, such that the run does not block
+            if self.error is None:
+                try:
+                    self.write(item)
+                    if time.time()-lastindex>1: # keep the index usable in case the run crashes
+                        for f in self.files.values():
+                            f.flush()
+                        self.writeindex('recording')
+                        lastindex = time.time()
+                except Exception as e: # e.g. disk full, finalize raises it
+                    print(f"Error: {e}, the recording stops")
+                    self.error = e
+            self.queue.task_done()
+
+    def write(self,item):
+        if item[0]=='eeg':
+            _,data,timestamps,chunk = item
+            data.tofile(self.files['eeg'])
+            timestamps.tofile(self.files['timestamps'])
+            chunk.tofile(self.files['chunks'])
+            self.written[0] += data.shape[0]
+        else:
+            item[1].tofile(self.files['events'])
+            self.written[1] += len(item[1])
+
+    def writeindex(self,state:str):
+        index = {'chanlist':self.chanlist,'nchan':self.nchan,'srate':self.srate,
+                 'nsamp':self.written[0],'nevents':self.written[1],'dtype':'float64',
+                 'eventfields':list(sessionrecorder.eventdtype.names),'state':state}
+        tmpname = os.path.join(self.path,'index.json.tmp')
+        with open(tmpname,'w') as f:
+            json.dump(index,f)
+        os.replace(tmpname,os.path.join(self.path,'index.json'))
+
+    def flush(self):
+        # waits until everything handed over so far is on disk
+        self.queue.join()
+        for f in self.files.values():
+            if not f.closed:
+                f.flush()
+
+    def eeg(self):
+        # channels x samples view of the recorded eeg (memory-mapped, no copy)
+        self.flush()
+        if self.written[0]==0:
+            return np.zeros((self.nchan,0))
+        return np.memmap(os.path.join(self.path,'eeg.bin'),dtype=np.float64,mode='r',shape=(self.written[0],self.nchan)).T
+
+    def finalize(self,matfilename:str='',extra:dict=None):
+        # stops the writer and optionally writes the legacy .mat file of nfrun,
+        # raises the error of the writer (the data written before it stays readable)
+        self.queue.put(None)
+        self.writer.join()
+        for f in self.files.values():
+            try:
+                f.close()
+            except OSError as e:
+                self.error = self.error or e
+        if self.error is not None:
+            self.writeindex('failed')
+            raise self.error
+        self.writeindex('finalized')
+        if matfilename:
+            data = {'eegsignals':self.eeg(),'srate':np.array(self.srate)}
+            data['lsltimestamps'] = np.fromfile(os.path.join(self.path,'timestamps.bin'),dtype=np.float64)
+            events = np.fromfile(os.path.join(self.path,'events.bin'),dtype=sessionrecorder.eventdtype)
+            for name in sessionrecorder.eventdtype.names:
+                data[name] = events[name]
+            data['preprocdata'] = np.zeros(0)
+            if extra is not None:
+                data.update(extra)
+            scipy.io.savemat(matfilename,data)
+
+class sessionreader:
+    # read access to a recording of sessionrecorder without loading it
+    # all data are memory-mapped, slicing only reads the touched part of the files
+    # provides the same window interface as rawdata, so it can be replayed and trained on
+    def __init__(self,path:str,chanlist:list=None):
+        path = os.path.normpath(path)
+        if path.endswith('.mat'): # the recording next to the .mat file of a run
+            path = path[:-4]+'.nfs'
+        self.path = path
+        with open(os.path.join(path,'index.json')) as f:
+            self.index = json.load(f)
+        self.srate = self.index['srate']
+        self.state = self.index['state']
+        # the recording may not be finalized (crashed run), trust the files more than the index
+        nchan = self.index['nchan']
+        nsamp = min(os.path.getsize(os.path.join(path,'eeg.bin'))//(8*nchan),
+                    os.path.getsize(os.path.join(path,'timestamps.bin'))//8)
+        nevents = os.path.getsize(os.path.join(path,'events.bin'))//sessionrecorder.eventdtype.itemsize
+        self.sampcount = self.nsamp = nsamp
+        self.eegsignals = self.mapfile('eeg',np.float64,(nsamp,nchan)).T # channels x samples
+        self.timestamps = self.mapfile('timestamps',np.float64,(nsamp,))
+        self.events = self.mapfile('events',sessionrecorder.eventdtype,(nevents,))
+        # channels in the order of chanlist (all recorded channels if not given)
+        self.chanlist = self.index['chanlist'] if chanlist is None else list(chanlist)
+        self.chans = self.channels(self.chanlist)
+        self.nchan = len(self.chans)
+        if self.chans == list(range(nchan)):
+            self.chans = slice(None) # keeps windows as views
+
+    def mapfile(self,name:str,dtype,shape:tuple):
+        if shape[0]==0: # empty files cannot be mapped
+            return np.zeros(shape,dtype=dtype)
+        return np.memmap(os.path.join(self.path,name+'.bin'),dtype=dtype,mode='r',shape=shape)
+
+    def channels(self,chans):
+        # channel indices from channel names or indices
+        names = [name.lower() for name in self.index['chanlist']]
+        indices = list()
+        for chan in chans:
+            if isinstance(chan,str):
+                if chan.lower() not in names:
+                    raise ValueError(f"channel {chan} not found in {self.path}")
+                chan = names.index(chan.lower())
+            indices.append(int(chan))
+        return indices
+
+    def window(self,startsamp:int,nsamp:int):
+        # samples startsamp ... startsamp+nsamp-1 of the selected channels
+        if startsamp<0 or startsamp+nsamp>self.sampcount:
+            raise ValueError("samples %d to %d are not in the recording" % (startsamp,startsamp+nsamp))
+        return self.eegsignals[self.chans, startsamp:startsamp+nsamp]
+    def timewindow(self,startsamp:int,nsamp:int):
+        return self.timestamps[startsamp:startsamp+nsamp]
+    def recorded(self):
+        return self.eegsignals[self.chans, :self.sampcount]
+
+    def timeslice(self,starttime:float=0,endtime:float=None,chans:list=None):
+        # data between starttime and endtime in sec from the start of the recording
+        startsamp = max(0,int(round(starttime*self.srate)))
+        endsamp = self.sampcount if endtime is None else min(self.sampcount,int(round(endtime*self.srate)))
+        if chans is None:
+            return self.eegsignals[self.chans, startsamp:endsamp]
+        return self.eegsignals[self.channels(chans), startsamp:endsamp]
+
+    def outcome(self):
+        # the feedback events as fbdata
+        outcome = fbdata(len(self.events))
+        outcome.table[:] = self.events
+        outcome.count = len(self.events)
+        return outcome
+
+    def eventwindows(self,windowwidth:float,events=None,chans:list=None):
+        # iterates over the windows of windowwidth sec that end at the given feedback events
+        # (all by default), as seen by the protocol; yields the event record and the window
+        windowsamps = round(windowwidth*self.srate)
+        chans = self.chans if chans is None else self.channels(chans)
+        if events is None:
+            events = range(len(self.events))
+        elif isinstance(events,slice):
+            events = range(len(self.events))[events]
+        for k in events:
+            event = self.events[k]
+            endsamp = int(event['position'])
+            if endsamp<windowsamps or endsamp>self.sampcount:
+                continue
+            yield event, self.eegsignals[chans, endsamp-windowsamps:endsamp]
+
+    def close(self):
+        # drops the mappings, the files are closed once no view is left
+        self.eegsignals = self.timestamps = self.events = None
+
 class io:
     def preparedata4mat(eeg:rawdata, outcome:fbdata):
-        data = { 'eegsignals':np.array(eeg.eegsignals), 
-                 'srate':np.array(eeg.srate),
-                 'timestamp':np.array(outcome.timestamp),
-                 'position':np.array(outcome.position),
-                 'amplitude':np.array(outcome.amplitude),
-                 'feedbackvalue':np.array(outcome.feedbackvalue),
-                 'loweredge':np.array(outcome.loweredge),
-                 'upperedge':np.array(outcome.upperedge),
-                 'preprocdata':np.array(outcome.preprocdata)} 
+        data = { 'eegsignals':np.asarray(eeg.recorded()), 
+                 'srate':np.array(eeg.srate)}
+        data.update(io.prepareoutcome4mat(outcome))
+        return data 
+    def prepareoutcome4mat(outcome:fbdata):
+        data = { 'timestamp':outcome.timestamp,
+                 'position':outcome.position,
+                 'amplitude':outcome.amplitude,
+                 'feedbackvalue':outcome.feedbackvalue,
+                 'loweredge':outcome.loweredge,
+                 'upperedge':outcome.upperedge,
+                 'preprocdata':outcome.preprocdata} 
         return data 
+    def loadmodel(filename:str):
+        # scalars are stored as 1x1 matrices in .mat files, squeeze them back
+        model = scipy.io.loadmat(filename, squeeze_me=True)
+        return {key:value for key,value in model.items() if not key.startswith('__')}
+    def loadsession(filename:str, chanlist:list):
+        # recorded run (.mat written by nfrun, .nfs recording) or BrainVision file (.vhdr, needs mne)
+        # returns a rawdata structure that holds the complete recording,
+        # recordings of sessionrecorder are memory-mapped instead (sessionreader)
+        if os.path.isdir(filename) or os.path.isdir(os.path.splitext(filename)[0]+'.nfs'):
+            return sessionreader(filename, chanlist)
+        if filename.lower().endswith('.vhdr'):
+            import mne
+            raw = mne.io.read_raw_brainvision(filename, preload=False, verbose='error')
+            names = [name.lower() for name in raw.ch_names]
+            missing = [chan for chan in chanlist if chan.lower() not in names]
+            if missing:
+                raise ValueError(f"channels {missing} not found in {filename}")
+            picks = [names.index(chan.lower()) for chan in chanlist]
+            signals = raw.get_data(picks=picks)*1e6 # in uV as streamed by the amplifiers
+            srate = raw.info['sfreq']
+        else:
+            data = scipy.io.loadmat(filename, variable_names=['eegsignals','srate'])
+            signals = data['eegsignals']
+            srate = np.squeeze(data['srate'])
+        eeg = rawdata(signals.shape[0], signals.shape[1])
+        eeg.srate = int(round(float(srate)))
+        eeg.adddata(signals)
+        return eeg
     def generatefilename(prm:params, subjcode):
         timestamp = time.strftime("%Y%m%d-%H%M%S") 
-        flist = glob.glob(os.path.join(prm.datapath, f"{subjcode}_run*.mat")) 
-        filename = f"{subjcode}_run{len(flist)}_{timestamp}.mat" 
+        # only count the runs, not the files stored along with them (e.g. _latency.mat)
+        # a run has a .mat file, a recording directory (.nfs) or both
+        flist = glob.glob(os.path.join(prm.datapath, f"{subjcode}_run*_{'[0-9]'*8}-{'[0-9]'*6}.*")) 
+        runs = set(os.path.splitext(f)[0] for f in flist if f.endswith(('.mat','.nfs')))
+        filename = f"{subjcode}_run{len(runs)}_{timestamp}.mat" 
         return os.path.join(prm.datapath, filename)
@@ -3,12 +3,20 @@ from tkinter import ttk, messagebox
 import subprocess
 import sys
 import os
+import time
+import queue
+import threading
+import nfsession
 
 class NeurofeedbackGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("Neurofeedback Control Panel")
         self.root.geometry("400x300")
+        # latest session: its tap (for the signal display) and feedback port (for the square)
+        self.session = None
+        # runs are sessions of one engine process (nfsession) that reports their status
+        self.client = None
         
         # Create data directory if it doesn't exist
         self.data_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
@@ -37,6 +45,7 @@ class NeurofeedbackGUI:
         
         ttk.Button(protocol_frame, text="Start Training", command=self.start_training).grid(row=0, column=0, padx=5, pady=5)
         ttk.Button(protocol_frame, text="Start Neurofeedback", command=self.start_neurofeedback).grid(row=0, column=1, padx=5, pady=5)
+        ttk.Button(protocol_frame, text="Stop", command=self.stop_sessions).grid(row=0, column=2, padx=5, pady=5)
         
         # Subject Code Entry
         subj_frame = ttk.Frame(main_frame)
@@ -52,18 +61,92 @@ class NeurofeedbackGUI:
         self.status_var.set(f"Ready - Data directory: {self.data_dir}")
         status_bar = ttk.Label(main_frame, textvariable=self.status_var, relief=tk.SUNKEN)
         status_bar.grid(row=4, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=10)
+        # the status is polled by a worker thread, such that a slow engine does not freeze the window
+        self.statusqueue = queue.Queue()
+        threading.Thread(target=self.poll_status, daemon=True).start()
+        self.root.after(200, self.show_status)
+
+    def engine(self):
+        # connects to the session engine, starts it if it is not running yet
+        if self.client is None:
+            try:
+                self.client = nfsession.client()
+            except OSError:
+                subprocess.Popen([sys.executable, "nfsession.py"])
+                for attempt in range(50):
+                    time.sleep(0.1)
+                    try:
+                        self.client = nfsession.client()
+                        break
+                    except OSError:
+                        pass
+                else:
+                    raise RuntimeError("session engine did not start")
+        return self.client
+
+    def request(self, cmd, **kwargs):
+        try:
+            reply = self.engine().request(cmd, **kwargs)
+        except (OSError, ValueError): # engine was closed, try once more
+            self.client = None
+            reply = self.engine().request(cmd, **kwargs)
+        if not reply.get('ok'):
+            raise RuntimeError(reply.get('error'))
+        return reply
+
+    def poll_status(self):
+        # worker thread: asks the engine for the sessions once a second over a connection of
+        # its own (the buttons use self.client), once the window has started the engine
+        client = None
+        while True:
+            if self.client is not None:
+                try:
+                    if client is None:
+                        client = nfsession.client()
+                    self.statusqueue.put(client.request('status')['sessions'])
+                except (OSError, ValueError):
+                    client = None
+            time.sleep(1)
+
+    def show_status(self):
+        # shows the state of the latest session, takes what the worker has without waiting
+        sessions = None
+        while not self.statusqueue.empty():
+            sessions = self.statusqueue.get_nowait()
+        if sessions:
+            s = sessions[-1]
+            text = f"Session {s['session']} ({s['mode']}, {s['subject']}): {s['state']}"
+            if 'seconds' in s:
+                text += f", {s['seconds']:.0f}/{s['runlength']} s"
+            if 'feedback' in s:
+                text += f", feedback {s['feedback']:.2f}"
+            self.status_var.set(text)
+        self.root.after(200, self.show_status)
+
+    def stop_sessions(self):
+        try:
+            self.request('stop')
+            self.status_var.set("Stopping")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to stop: {str(e)}")
 
     def start_signal_display(self):
         try:
             subprocess.Popen([sys.executable, "generateThetaSignal.py"])  # Start signal generator first
-            subprocess.Popen([sys.executable, "nfshowsignals.py"])
+            if self.session is not None: # data of the latest session
+                subprocess.Popen([sys.executable, "nfshowsignals.py", "--shm", self.session['tapname']])
+            else:
+                subprocess.Popen([sys.executable, "nfshowsignals.py"])
             self.status_var.set("Signal display and generator started")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to start signal display: {str(e)}")
 
     def start_square_display(self):
         try:
-            subprocess.Popen([sys.executable, "nfshowsquare.py"])
+            if self.session is not None: # feedback of the latest session
+                subprocess.Popen([sys.executable, "nfshowsquare.py", "--port", str(self.session['fbport'])])
+            else:
+                subprocess.Popen([sys.executable, "nfshowsquare.py"])
             self.status_var.set("Square display started")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to start square display: {str(e)}")
@@ -74,8 +157,9 @@ class NeurofeedbackGUI:
             messagebox.showwarning("Warning", "Please enter a subject code")
             return
         try:
-            subprocess.Popen([sys.executable, "nfrun.py", "-m", "calib", "-s", subject])
-            self.status_var.set(f"Training started for subject {subject}")
+            self.session = self.request('start_calibration', subject=subject, tap=True)
+            self.start_square_display() # each session sends its feedback to its own port
+            self.status_var.set(f"Training started for subject {subject} (session {self.session['session']})")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to start training: {str(e)}")
 
@@ -85,8 +169,9 @@ class NeurofeedbackGUI:
             messagebox.showwarning("Warning", "Please enter a subject code")
             return
         try:
-            subprocess.Popen([sys.executable, "nfrun.py", "-m", "nf", "-s", subject])
-            self.status_var.set(f"Neurofeedback started for subject {subject}")
+            self.session = self.request('start_nf', subject=subject, tap=True)
+            self.start_square_display() # each session sends its feedback to its own port
+            self.status_var.set(f"Neurofeedback started for subject {subject} (session {self.session['session']})")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to start neurofeedback: {str(e)}")
 
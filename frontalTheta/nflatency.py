@@ -0,0 +1,90 @@
+import numpy as np
+import socket, json
+from pylsl import local_clock
+
+class latencymonitor:
+    # per feedback event timings from the lsl timestamp of the newest sample
+    # until the feedback packet is sent, all in sec (lsl clock)
+    # acquisition: newest sample -> start of processing (transport and waiting)
+    # filter, spectral, apply, send: duration of each processing step
+    # total: newest sample -> feedback sent
+    stages = ['acquisition','filter','spectral','apply','send','total']
+
+    def __init__(self,nevents:int=1000,publishport:int=0):
+        self.times = np.full((nevents,len(latencymonitor.stages)),np.nan)
+        self.count = 0
+        self.sampletime = 0
+        self.last = 0
+        self.sock = None
+        self.publishaddr = ("127.0.0.1",publishport)
+        self.display = dict() # reports of the feedback display (nfcomm.udpfeedback.reportdict)
+        if publishport>0: # publish every event as json via udp
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def start(self,sampletime:float):
+        # begin of a feedback event, sampletime is the lsl timestamp of the newest sample
+        if self.count >= self.times.shape[0]:
+            self.times = np.vstack((self.times,np.full(self.times.shape,np.nan)))
+        self.last = local_clock()
+        self.sampletime = sampletime
+        self.times[self.count,:] = np.nan
+        self.times[self.count,0] = self.last-sampletime
+
+    def mark(self,stage:str):
+        # the given stage has just finished
+        now = local_clock()
+        self.times[self.count,latencymonitor.stages.index(stage)] = now-self.last
+        self.last = now
+
+    def stop(self):
+        self.times[self.count,-1] = self.last-self.sampletime
+        if self.sock is not None:
+            msg = dict(zip(latencymonitor.stages,np.nan_to_num(self.times[self.count,:]).tolist()))
+            msg['event'] = self.count
+            self.sock.sendto(json.dumps(msg).encode("ASCII"), self.publishaddr)
+        self.count += 1
+
+    def percentiles(self,q=(50,90,99,99.9)):
+        # stages x percentiles in sec
+        if self.count==0:
+            return np.full((len(latencymonitor.stages),len(q)),np.nan)
+        return np.nanpercentile(self.times[:self.count,:],q,axis=0).T
+
+    def histograms(self,binwidth:float=0.0005,maxlatency:float=0.5):
+        # counts per stage in bins of binwidth sec, the last bin collects everything above
+        edges = np.append(np.arange(0,maxlatency,binwidth),np.inf)
+        counts = np.zeros((len(latencymonitor.stages),len(edges)-1),dtype=int)
+        for k in range(len(latencymonitor.stages)):
+            values = self.times[:self.count,k]
+            counts[k,:],_ = np.histogram(values[~np.isnan(values)],edges)
+        return edges[:-1],counts
+
+    def report(self):
+        q = (50,90,99)
+        p = self.percentiles(q)
+        lines = ["latency (ms) %8s %8s %8s" % tuple("p%d" % v for v in q)]
+        for k,stage in enumerate(latencymonitor.stages):
+            lines.append("%-12s %8.2f %8.2f %8.2f" % ((stage,)+tuple(p[k,:]*1000)))
+        if len(self.display.get('displayseq',[]))>0:
+            for stage in ('transport','photon'):
+                values = np.percentile(self.display['display'+stage],q)
+                lines.append("%-12s %8.2f %8.2f %8.2f" % ((stage,)+tuple(values*1000)))
+            lines.append("display: %d packets shown, %d dropped, %d out of order"
+                         % (len(self.display['displayseq']),self.display['displaydropped'],self.display['displayoutoforder']))
+        return "\n".join(lines)
+
+    def todict(self):
+        # for scipy.io.savemat
+        edges,counts = self.histograms()
+        return {'stages':np.array(latencymonitor.stages,dtype=object),
+                'times':self.times[:self.count,:],
+                'percentiles':self.percentiles(),
+                'percentilelevels':np.array([50,90,99,99.9]),
+                'histedges':edges,
+                'histcounts':counts,
+                **self.display}
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
@@ -0,0 +1,191 @@
+import numpy as np
+import json, queue, time, types
+from pylsl import local_clock
+
+# acquisition directly from the F1 amplifier via mqtt (no F1toLSLInterface, no lsl)
+# data/samples messages hold [beg, end] as uint32 followed by int32 samples,
+# sample by sample (all channels of a sample are adjacent), as in F1toLSLInterface.cpp
+
+topic_info = "state/device/info"
+topic_samples = "data/samples"
+topic_action_start = "action/sampling/start"
+topic_action_stop = "action/sampling/stop"
+
+def decode(payload):
+    # beg, end and a samples x channels int32 view of the message (no copy)
+    beg, end = np.frombuffer(payload, dtype=np.uint32, count=2)
+    nsamp = int(end)-int(beg)
+    values = np.frombuffer(payload, dtype=np.int32, offset=8)
+    if nsamp<=0 or len(values) % nsamp != 0:
+        raise ValueError("invalid samples message: %d values for samples %d to %d" % (len(values),beg,end))
+    return int(beg), int(end), values.reshape((nsamp, len(values)//nsamp))
+
+class f1reader:
+    # reads the F1 with the interface of nfcomm.lslreader (connect, readinto, readdata)
+    # the mqtt network thread only queues the messages, decoding happens in readinto
+    # client can be any object with the interface of paho.mqtt.client.Client (e.g. fakebroker.client())
+    def __init__(self,chanlist,maxchunk=1024,timeout=0.1,host="172.31.1.1",client=None,
+                 reference=("Fpz",),srate=500,outputrate=20.0):
+        self.chanlist = chanlist
+        self.neegchan = len(chanlist)
+        self.maxchunk = maxchunk # max number of samples per readinto
+        self.timeout = timeout # in sec, readinto waits this long for new samples
+        self.host = host
+        self.client = client
+        self.srate = srate
+        self.settings = {"channel_label":list(chanlist),"data_format":0.0,"gain":12.0,
+                         "impedance_interval":0.0,"layout":1.0,"marker_id":"",
+                         "output_rate":outputrate,"radio_bandw":13.0,"radio_chan":1.0,
+                         "reference":list(reference),"sampling_rate":float(srate)}
+        self.messages = queue.SimpleQueue()
+        self.scale_uV = 0.5364 # replaced by scale_to_uV of the device info
+        self.buffer = np.zeros((maxchunk,self.neegchan))
+        self.timestamps = np.zeros(maxchunk)
+        self.pending = None # samples of a message that did not fit into the last readinto
+        self.prev_end = -1 # end of the last data message, see is_distinct in F1toLSLInterface.cpp
+        self.starttime = 0 # lsl time of sample 0
+        self.gaps = 0 # lost samples
+        self.duplicates = 0 # samples received more than once
+
+    def on_connect(self,client,userdata,flags,rc,properties=None):
+        client.subscribe("state/#",1)
+        client.subscribe("data/#",0)
+    def on_message(self,client,userdata,message):
+        # network thread: no work here, just hand the message over
+        self.messages.put((message.topic,message.payload))
+
+    def connect(self,timeout=10.0):
+        # connects to the broker, waits for the device info and starts sampling
+        if self.client is None:
+            import paho.mqtt.client as mqtt
+            if hasattr(mqtt,'CallbackAPIVersion'): # paho 2
+                self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1,"nfrun")
+            else:
+                self.client = mqtt.Client("nfrun")
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        print("Connecting to the F1 at %s ..." % self.host)
+        self.client.connect(self.host)
+        self.client.loop_start()
+        endtime = time.time()+timeout
+        while time.time()<endtime:
+            try:
+                topic, payload = self.messages.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if topic == topic_info:
+                info = json.loads(payload)
+                self.scale_uV = info.get("scale_to_uV",self.scale_uV)
+                self.client.publish(topic_action_start,json.dumps(self.settings))
+                return 0
+        print("No device info from the F1.")
+        return -1
+
+    def distinct(self,beg:int,end:int,data:np.array):
+        # checks a data message against the previous one: returns the samples that are new
+        # (duplicates and overlaps are dropped, gaps are counted)
+        if self.prev_end >= 0:
+            if end <= self.prev_end:
+                self.duplicates += end-beg
+                return data[:0], end
+            if beg < self.prev_end:
+                self.duplicates += self.prev_end-beg
+                data = data[self.prev_end-beg:]
+                beg = self.prev_end
+            elif beg > self.prev_end:
+                self.gaps += beg-self.prev_end
+        else: # first message
+            self.starttime = local_clock()-end/self.srate
+        self.prev_end = end
+        return data, beg
+
+    def nextmessage(self,timeout):
+        # samples x channels of the next data message and the position of its first sample
+        while True:
+            try:
+                topic, payload = self.messages.get(timeout=timeout) if timeout>0 else self.messages.get_nowait()
+            except queue.Empty:
+                return None
+            if topic != topic_samples:
+                continue
+            beg, end, data = decode(payload)
+            data, beg = self.distinct(beg,end,data)
+            if len(data)>0:
+                return data, beg
+
+    def readinto(self):
+        # waits up to self.timeout for samples and returns a channels x samples view of the
+        # preallocated buffer and the timestamps (lsl clock), both only valid until the next call
+        nsamp = 0
+        timestamps = self.timestamps
+        timeout = self.timeout
+        while nsamp < self.maxchunk:
+            if self.pending is not None:
+                data, beg = self.pending
+                self.pending = None
+            else:
+                message = self.nextmessage(timeout)
+                if message is None:
+                    break
+                data, beg = message
+            timeout = 0 # only wait for the first message
+            n = min(len(data), self.maxchunk-nsamp)
+            np.multiply(data[:n,:self.neegchan], self.scale_uV, out=self.buffer[nsamp:nsamp+n,:])
+            timestamps[nsamp:nsamp+n] = self.starttime + (beg+np.arange(n))/self.srate
+            if n < len(data):
+                self.pending = (data[n:], beg+n)
+            nsamp += n
+        return self.buffer[:nsamp,:].T, timestamps[:nsamp]
+
+    def readdata(self):
+        chunk, _ = self.readinto()
+        return np.array(chunk)
+
+    def close(self):
+        if self.client is not None:
+            self.client.publish(topic_action_stop,"")
+            self.client.loop_stop()
+            self.client.disconnect()
+
+class fakebroker:
+    # in-process replacement of an mqtt broker for tests: messages published by one
+    # client are delivered synchronously to the subscribed clients
+    def __init__(self):
+        self.clients = list()
+    def client(self):
+        c = fakeclient(self)
+        self.clients.append(c)
+        return c
+    def publish(self,topic:str,payload):
+        if isinstance(payload,str):
+            payload = payload.encode()
+        message = types.SimpleNamespace(topic=topic,payload=bytes(payload))
+        for c in self.clients:
+            if c.connected and any(fakebroker.matches(pattern,topic) for pattern in c.subscriptions):
+                c.on_message(c,None,message)
+    def matches(pattern:str,topic:str):
+        if pattern.endswith("#"):
+            return topic.startswith(pattern[:-1])
+        return pattern == topic
+
+class fakeclient:
+    def __init__(self,broker:fakebroker):
+        self.broker = broker
+        self.subscriptions = list()
+        self.connected = False
+        self.on_connect = None
+        self.on_message = None
+    def connect(self,host=None,*args,**kwargs):
+        self.connected = True
+        if self.on_connect is not None:
+            self.on_connect(self,None,{},0)
+    def subscribe(self,topic:str,qos:int=0):
+        self.subscriptions.append(topic)
+    def publish(self,topic:str,payload=b"",*args,**kwargs):
+        self.broker.publish(topic,payload)
+    def loop_start(self):
+        pass
+    def loop_stop(self):
+        pass
+    def disconnect(self):
+        self.connected = False
@@ -0,0 +1,211 @@
+import nfcomm
+import nfdata
+import nfprocess
+import nflatency
+import scipy.io
+import multiprocessing as mp
+import os, time, queue
+from pylsl import local_clock
+
+# pipelined run: acquisition, feedback computation and recording run in separate
+# processes that share the eeg data through a shared memory ring buffer (nfdata.shmring)
+# the recorder is a registered reader of the ring and holds back acquisition if it falls
+# behind (backpressure); the feedback stage only looks at the latest window
+# the parent watches the stages: if one of them dies, the ring is closed with the error
+# flag, the others stop and the recorder saves what it got
+
+RECORDER = 0 # reader index of the recording stage
+RESULTSTIMEOUT = 10 # in sec, the feedback stage sends its results within this time after the end of the data
+
+class stagestats:
+    # latency counters of one stage in shared memory: count, total, max (in sec), stalls
+    def __init__(self,name:str):
+        self.name = name
+        self.values = mp.Array('d',4)
+    def add(self,latency:float):
+        with self.values.get_lock():
+            self.values[0] += 1
+            self.values[1] += latency
+            self.values[2] = max(self.values[2],latency)
+    def stall(self):
+        with self.values.get_lock():
+            self.values[3] += 1
+    def report(self):
+        count,total,maxlat,stalls = self.values[:]
+        mean = total/count if count>0 else 0
+        return "%-11s %7d events, mean %6.1f ms, max %6.1f ms, %d stalls" % (self.name,count,mean*1000,maxlat*1000,stalls)
+
+def acquire(ringname:str,chanlist:list,prm:nfdata.params,newdata,stats:stagestats):
+    ring = nfdata.shmring(ringname)
+    lsl = nfcomm.eegreader(prm,chanlist,ring.srate)
+    lsl.connect()
+    tap = None
+    if prm.tapname: # display processes look at the same data
+        filters = nfprocess.filterbank(ring.nchan, ring.srate, nfprocess.frontaltheta().filterstages()) if prm.tapfiltered else None
+        tap = nfdata.shmtap(prm.tapname, ring.nchan, ring.srate, round(ring.srate*prm.taplength), filters)
+    while ring.sampcount < ring.nsamp and not ring.closed:
+        chunk, timestamps = lsl.readinto()
+        if tap is not None:
+            tap.write(chunk,timestamps)
+        written = 0
+        while written < chunk.shape[1] and ring.sampcount < ring.nsamp and not ring.closed:
+            n = ring.write(chunk[:,written:],timestamps[written:])
+            if n==0: # recorder is behind
+                stats.stall()
+            written += n
+            with newdata:
+                newdata.notify_all()
+        if chunk.shape[1]>0:
+            stats.add(local_clock()-timestamps[-1])
+    lsl.close()
+    ring.finish()
+    with newdata:
+        newdata.notify_all()
+    if tap is not None:
+        tap.close()
+    ring.close()
+
+def feedback(ringname:str,mode:str,model:dict,prm:nfdata.params,newdata,results,stats:stagestats):
+    ring = nfdata.shmring(ringname)
+    if prm.fbmodule=="blueSquareUDP":
+        fbm = nfcomm.udpfeedback()
+        fbm.connect()
+        fbm.listenreports()
+    if prm.fbprotocol=="frontaltheta":
+        fbp = nfprocess.frontaltheta()
+    fbm.sendcolor(fbp.startcolor)
+    snippet = nfprocess.datasnippet(fbp,ring.srate,prm.filtermode)
+    fbp.outcome = nfdata.fbdata(round(ring.nsamp/ring.srate/fbp.fbrefresh)+1)
+    fbp.monitor = nflatency.latencymonitor(round(ring.nsamp/ring.srate/fbp.fbrefresh)+1,prm.latencyport)
+    lastevent = -1
+    while True:
+        if ring.sampcount > snippet.nextfbevent and snippet.nextfbevent != lastevent:
+            lastevent = snippet.nextfbevent # the last event stays at the end of the data
+            if mode=="nf": # we only process the data in nf mode
+                if ring.sampcount-snippet.nextfbevent > ring.ringsamps-snippet.windowsamps:
+                    # fell too far behind, continue with the latest data
+                    stats.stall()
+                    snippet.nextfbevent = ring.sampcount-1
+                    snippet.filteredcount = max(snippet.filteredcount,snippet.nextfbevent-snippet.windowsamps)
+                fbp.monitor.start(ring.timewindow(snippet.nextfbevent-1,1)[0])
+                snippet.refresh(ring)
+                success = fbp.process(snippet,model)
+                if success <0 and fbp.sendartifactfb:
+                    fbm.sendcolor(fbp.artifactcolor)
+                else:
+                    fbm.sendfeedback(fbp.feedbackvalue)
+                fbp.monitor.mark('send')
+                fbp.monitor.stop()
+                stats.add(fbp.monitor.times[fbp.monitor.count-1,-1])
+                fbm.readreports()
+            else:
+                snippet.nextfbevent = ring.sampcount
+        elif ring.closed: # all events up to the end of the data are done
+            break
+        else:
+            with newdata:
+                newdata.wait(0.1)
+    # hide the square
+    fbm.sendcolor((0,0,0))
+    fbm.readreports()
+    fbp.monitor.display = fbm.reportdict()
+    fbm.close()
+    fbp.monitor.close()
+    results.put((fbp.outcome,fbp.low_edge,fbp.high_edge,fbp.monitor))
+    del snippet
+    ring.close()
+
+def record(ringname:str,chanlist:list,mode:str,model:dict,modelfilename:str,filename:str,prm:nfdata.params,newdata,results,stats:stagestats):
+    ring = nfdata.shmring(ringname)
+    eeg = nfdata.rawdata(ring.nchan,ring.nsamp,round(ring.srate*prm.bufferlength))
+    eeg.srate = ring.srate
+    recorder = nfdata.sessionrecorder(filename.replace('.mat','.nfs'),chanlist,ring.srate)
+    eeg.record(recorder)
+    while True:
+        start, nsamp = ring.unread(RECORDER)
+        if nsamp>0:
+            timestamps = ring.timewindow(start,nsamp)
+            eeg.adddata(ring.window(start,nsamp),timestamps)
+            stats.add(local_clock()-timestamps[-1]) # from acquisition until handed to the writer
+            ring.release(RECORDER,nsamp)
+        elif ring.closed:
+            break
+        else:
+            with newdata:
+                newdata.wait(0.1)
+    if ring.failed:
+        print("Run stopped early, recorded %d of %d samples." % (ring.sampcount,ring.nsamp))
+    # the parent sends None if the feedback stage dies, if it hangs the recording is
+    # saved without the results after RESULTSTIMEOUT
+    result = None
+    deadline = time.time()+RESULTSTIMEOUT
+    while time.time() < deadline:
+        try:
+            result = results.get(timeout=0.5)
+            break
+        except queue.Empty:
+            pass
+    if result is None: # the feedback stage failed, only keep the recording
+        print("No results from the feedback stage, saving the recording only.")
+        recorder.finalize()
+        eeg.close()
+        ring.close()
+        return
+    outcome, low_edge, high_edge, monitor = result
+    if mode[0] == "c": # calibration
+        if prm.fbprotocol=="frontaltheta":
+            fbp = nfprocess.frontaltheta()
+        model = fbp.train(eeg)
+    else:
+        model['loweredge'] = low_edge
+        model['upperedge'] = high_edge
+    # save the model and finish the recording
+    scipy.io.savemat(modelfilename,model)
+    recorder.addevents(outcome)
+    if prm.legacymat:
+        recorder.finalize(filename,{'preprocdata':outcome.preprocdata})
+    else:
+        recorder.finalize()
+    if monitor.count>0:
+        scipy.io.savemat(filename.replace('.mat','_latency.mat'),monitor.todict())
+        print(monitor.report())
+    eeg.close()
+    ring.close()
+
+def run(mode:str,model:dict,modelfilename:str,filename:str,prm:nfdata.params,chanlist:list,srate:int,runlength:float):
+    nsamp = round(srate*runlength)
+    # the ring buffer has to hold a feedback window and gives the recorder some slack
+    ringsamps = round(srate*max(10,prm.bufferlength))
+    ringname = "nf%d" % os.getpid()
+    ring = nfdata.shmring(ringname,len(chanlist),ringsamps,1,nsamp,srate,create=True)
+    newdata = mp.Condition()
+    results = mp.Queue()
+    stats = [stagestats('acquisition'),stagestats('feedback'),stagestats('recording')]
+    workers = [mp.Process(target=record,name='recording',args=(ringname,chanlist,mode,model,modelfilename,filename,prm,newdata,results,stats[2])),
+               mp.Process(target=feedback,name='feedback',args=(ringname,mode,model,prm,newdata,results,stats[1])),
+               mp.Process(target=acquire,name='acquisition',args=(ringname,chanlist,prm,newdata,stats[0]))]
+    for w in workers:
+        w.start()
+    recorder, fbstage = workers[:2]
+    fbfailed = False
+    while recorder.is_alive():
+        recorder.join(0.5)
+        failed = [w for w in workers if w.exitcode not in (None,0)]
+        if failed and not ring.closed:
+            print("%s stage died (exit code %d), stopping the run." % (failed[0].name,failed[0].exitcode))
+            ring.finish(error=True)
+            with newdata:
+                newdata.notify_all()
+        if fbstage.exitcode not in (None,0) and not fbfailed:
+            fbfailed = True
+            results.put(None) # the recorder does not wait for the results
+    for w in workers:
+        w.join(5)
+        if w.is_alive():
+            print("%s stage does not stop, terminating it." % w.name)
+            w.terminate()
+            w.join()
+    for s in stats:
+        print(s.report())
+    ring.close()
+    ring.unlink()
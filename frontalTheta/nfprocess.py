@@ -1,23 +1,274 @@
 import nfdata
 import numpy as np
 import scipy.signal
-from scipy.fftpack import fft 
 import time
+import functools
 import matplotlib.pyplot as plt
 
+@functools.lru_cache(maxsize=None)
+def _designfilter(order,cutoff,srate,btype,output):
+    wn = np.array(cutoff) / (0.5 * srate)
+    if len(cutoff)==1:
+        wn = wn[0]
+    return scipy.signal.butter(order, wn, btype=btype, output=output)
+
+class filterbank:
+    # cascade of butterworth filters designed once as second-order sections
+    # in causal mode the filter state of each channel is carried over between calls
+    # such that every sample is filtered exactly once (online feedback)
+    # in zerophase mode each call is filtered forward and backward (offline use)
+    def __init__(self,nchan:int,srate:float,stages:list,mode:str='causal'):
+        # stages is a list of (order, cutoff, btype) tuples applied in the given order
+        self.nchan = nchan
+        self.srate = srate
+        self.mode = mode
+        self.sos = np.vstack([process.designfilter(order, cutoff, srate, btype, 'sos') for order,cutoff,btype in stages])
+        self.zi = np.zeros((self.sos.shape[0], nchan, 2))
+        self.initialized = False
+
+    def reset(self):
+        self.zi[:] = 0
+        self.initialized = False
+
+    def filter(self,signal:np.array):
+        if self.mode == 'zerophase':
+            return scipy.signal.sosfiltfilt( self.sos, signal, axis=1, padtype='odd')
+        if signal.shape[1]==0:
+            return np.zeros(signal.shape)
+        if not self.initialized:
+            # start from the steady state of the first sample to avoid a large onset transient
+            self.zi = scipy.signal.sosfilt_zi(self.sos)[:,np.newaxis,:] * signal[np.newaxis,:,0,np.newaxis]
+            self.initialized = True
+        filtered_data, self.zi = scipy.signal.sosfilt( self.sos, signal, axis=1, zi=self.zi)
+        return filtered_data
+
+class spatialfilter:
+    # re-referencing as a matrix (targets x channels) applied with a single matmul
+    # montage 'none' keeps the target channels as they are, 'reference' subtracts the
+    # weighted reference channels of each target, 'laplacian' subtracts the mean of the
+    # good reference channels (neighbours) of each target, 'average' subtracts the mean
+    # of all channels except the reference channels found bad (common average reference)
+    # and 'custom' uses the given matrix
+    # the matrix is only rebuilt when the set of good reference channels changes
+    # an optional cleaning matrix (icacleaner) is composed into the matrix
+    def __init__(self,nchan:int,targetchans:np.array,refchans:np.array,weights:np.array,montage:str='reference',matrix:np.array=None):
+        self.nchan = nchan
+        self.targetchans = np.array(targetchans)
+        self.refchans = np.array(refchans).reshape((len(self.targetchans),-1))
+        self.weights = np.array(weights).reshape(self.refchans.shape)
+        self.montage = montage
+        self.goodchans = None
+        self.out = np.zeros((0,0))
+        self.cleaning = None # channels x channels applied before the montage (see icacleaner)
+        if montage=='custom':
+            self.reference = np.array(matrix,dtype=float)
+            self.matrix = self.reference
+        else:
+            self.update(np.arange(self.refchans.shape[1]))
+
+    def setcleaning(self,cleaning:np.array):
+        # composes the cleaning matrix into the montage, such that cleaning and
+        # re-referencing stay a single matmul (None removes the cleaning)
+        if cleaning is self.cleaning:
+            return
+        self.cleaning = cleaning
+        self.compose()
+
+    def compose(self):
+        if self.cleaning is None:
+            self.matrix = self.reference
+        else:
+            self.matrix = self.reference @ np.reshape(self.cleaning,(self.nchan,self.nchan))
+
+    def update(self,goodchans:np.array):
+        # goodchans are column indices into refchans (as returned by process.precheck)
+        goodchans = tuple(np.array(goodchans).ravel().tolist())
+        if self.montage=='custom' or goodchans==self.goodchans:
+            return
+        self.goodchans = goodchans
+        good = list(goodchans)
+        matrix = np.zeros((len(self.targetchans),self.nchan))
+        if self.montage=='average': # only the reference channels are checked by precheck
+            chans = np.setdiff1d(np.arange(self.nchan),np.setdiff1d(self.refchans,self.refchans[:,good]))
+        for k in range(len(self.targetchans)):
+            matrix[k,self.targetchans[k]] = 1
+            refs = self.refchans[k,good]
+            if self.montage=='reference':
+                np.subtract.at(matrix[k],refs,self.weights[k,good])
+            elif self.montage=='laplacian' and len(refs)>0:
+                np.subtract.at(matrix[k],refs,1/len(refs))
+            elif self.montage=='average':
+                matrix[k,chans] -= 1/len(chans)
+        self.reference = matrix
+        self.compose()
+
+    def apply(self,signal:np.array):
+        # channels x samples -> targets x samples, written into a preallocated output
+        if self.out.shape != (self.matrix.shape[0],signal.shape[1]):
+            self.out = np.zeros((self.matrix.shape[0],signal.shape[1]))
+        return np.matmul(self.matrix,signal,out=self.out)
+
+class icacleaner:
+    # artifact removal learned once from the calibration run (as the ica of
+    # Artifact_Detection/Demo.py, but without mne and without clicking components):
+    # fastica gives the unmixing matrix (components x channels) and its mixing matrix,
+    # components that look like blinks or eye movements are flagged automatically and
+    # cleaning = mixing[:,keep] @ unmixing[keep,:] removes them from every chunk with a
+    # single matmul (channels x channels), nothing is refitted during feedback
+    # a component is flagged when it correlates with one of the eog channels (frontal
+    # channels next to the eyes) by at least eogcorr and is peaky (blinks) with an excess
+    # kurtosis of at least eogkurtosis, at most maxremove components are removed
+    def __init__(self,ncomp:int=0,eogcorr:float=0.7,eogkurtosis:float=2.0,maxremove:int=2,
+                 maxiter:int=200,tol:float=1e-4,seed:int=0):
+        self.ncomp = ncomp # 0 uses all channels (limited by the rank of the data)
+        self.eogcorr = eogcorr
+        self.eogkurtosis = eogkurtosis
+        self.maxremove = maxremove
+        self.maxiter = maxiter
+        self.tol = tol
+        self.seed = seed # fixed, such that the same calibration gives the same model
+        self.unmixing = None
+        self.mixing = None
+        self.badcomponents = np.zeros(0,dtype=int)
+        self.scores = None # correlation and kurtosis of each component
+
+    def fastica(self,data:np.array):
+        # symmetric fastica (logcosh contrast) on centered and whitened data
+        # returns the unmixing matrix of the channels (components x channels)
+        data = data - np.mean(data,axis=1,keepdims=True)
+        d, e = np.linalg.eigh(np.cov(data))
+        order = np.argsort(d)[::-1]
+        rank = int(np.sum(d > d[order[0]]*1e-10))
+        ncomp = min(self.ncomp or rank, rank)
+        d, e = d[order[:ncomp]], e[:,order[:ncomp]]
+        whitening = (e / np.sqrt(d)).T
+        z = whitening @ data
+        rng = np.random.default_rng(self.seed)
+        w = icacleaner.decorrelate(rng.standard_normal((ncomp,ncomp)))
+        for _ in range(self.maxiter):
+            g = np.tanh(w @ z)
+            wnew = icacleaner.decorrelate(g @ z.T / z.shape[1] - np.mean(1-g**2,axis=1)[:,np.newaxis]*w)
+            converged = np.max(np.abs(np.abs(np.sum(wnew*w,axis=1))-1)) < self.tol
+            w = wnew
+            if converged:
+                break
+        return w @ whitening
+
+    def decorrelate(w:np.array):
+        # symmetric decorrelation (w w')^(-1/2) w
+        s, u = np.linalg.eigh(w @ w.T)
+        return (u / np.sqrt(s)) @ u.T @ w
+
+    def fit(self,data:np.array,eogchans):
+        # data is channels x samples (filtered calibration data), eogchans are channel indices
+        self.unmixing = self.fastica(data)
+        self.mixing = np.linalg.pinv(self.unmixing)
+        sources = self.unmixing @ data
+        sources = sources - np.mean(sources,axis=1,keepdims=True)
+        sources /= np.std(sources,axis=1,keepdims=True)
+        kurtosis = np.mean(sources**4,axis=1) - 3
+        eogchans = np.atleast_1d(eogchans).astype(int)
+        if len(eogchans)>0:
+            eog = data[eogchans,:] - np.mean(data[eogchans,:],axis=1,keepdims=True)
+            eog /= np.maximum(np.std(eog,axis=1,keepdims=True),1e-12) # flat channels correlate with nothing
+            corr = np.max(np.abs(sources @ eog.T / data.shape[1]),axis=1)
+        else:
+            corr = np.zeros(len(sources))
+        self.scores = np.column_stack((corr,kurtosis))
+        flagged = np.where((corr>=self.eogcorr) & (kurtosis>=self.eogkurtosis))[0]
+        # the most eog like components first
+        self.badcomponents = np.sort(flagged[np.argsort(-corr[flagged])][:self.maxremove])
+        return self
+
+    @property
+    def matrix(self):
+        # cleaning matrix (channels x channels)
+        keep = np.setdiff1d(np.arange(len(self.unmixing)),self.badcomponents)
+        return self.mixing[:,keep] @ self.unmixing[keep,:]
+
+    def apply(self,signal:np.array):
+        return self.matrix @ signal
+
+class spectralplan:
+    # precomputed taper, padding length and frequency bins for a given
+    # window length, srate and set of target frequencies
+    # mode 'fft' uses a real fft, 'dft' only evaluates the target bins (goertzel like)
+    # 'auto' picks dft for few target frequencies
+    _plans = dict()
+
+    def get(windowsamps:int,srate:float,targetfreqs,mode:str='auto'):
+        # returns a cached plan, such that it is built only once per protocol
+        key = (windowsamps, float(srate), tuple(targetfreqs), mode)
+        if key not in spectralplan._plans:
+            spectralplan._plans[key] = spectralplan(windowsamps, srate, targetfreqs, mode)
+        return spectralplan._plans[key]
+
+    def __init__(self,windowsamps:int,srate:float,targetfreqs,mode:str='auto'):
+        self.windowsamps = windowsamps
+        self.srate = srate
+        self.targetfreqs = np.array(targetfreqs,dtype=float)
+        if len(targetfreqs)==1:
+            fres = 1
+        else:
+            fres = max(0.05, min(1,min(np.diff(targetfreqs))))
+        self.nfft = round(srate/fres) # zero padded (or truncated) length of the fft
+        self.window = np.hamming(windowsamps)
+        self.bins = np.round(self.targetfreqs*self.nfft/srate).astype(int)
+        if mode=='auto':
+            mode = 'dft' if len(targetfreqs)<=8 else 'fft'
+        self.mode = mode
+        if mode=='dft':
+            # tapered complex exponentials of the target bins, fft(x,n) truncates x to n samples
+            nused = min(windowsamps,self.nfft)
+            t = np.arange(nused)
+            self.kernel = np.zeros((windowsamps,len(self.bins)),dtype=complex)
+            self.kernel[:nused,:] = self.window[:nused,np.newaxis] * np.exp(-2j*np.pi*np.outer(t,self.bins)/self.nfft)
+
+    def power(self,signal:np.array):
+        # signal is channels x samples, returns channels x targetfreqs
+        if self.mode=='dft':
+            return np.abs(signal @ self.kernel)**2
+        spectrum = np.fft.rfft(signal*self.window, self.nfft, axis=-1)
+        return np.abs(spectrum[...,self.bins])**2
+
+    def logpower(self,signal:np.array):
+        return np.log(self.power(signal))
+
 class datasnippet:
-    def __init__(self,fbp,srate):
+    def __init__(self,fbp,srate,filtermode:str='window'):
+        # filtermode 'window' leaves filtering to the protocol (each window is filtered again),
+        # 'causal' and 'zerophase' fill self.filtered using the filterbank of the protocol,
+        # 'prefiltered' is for data that already went through the filters of the protocol
         self.srate = srate
         self.refreshsamps = round( fbp.fbrefresh * srate)
         self.windowsamps = round( fbp.windowwidth * srate)
         self.curfbevent = self.windowsamps
         self.nextfbevent = self.windowsamps
         self.chunk = np.zeros((len( fbp.chanlist),self.windowsamps))
+        self.filtermode = filtermode
+        self.filtered = np.zeros(self.chunk.shape)
+        self.filteredcount = 0 # number of samples that went through the causal filters
+        if filtermode in ('causal','zerophase'):
+            self.filters = filterbank(len( fbp.chanlist), srate, fbp.filterstages(), filtermode)
+        else:
+            self.filters = None
 
     def refresh(self,eeg: nfdata.rawdata):
         startsamp = max(0,self.nextfbevent-self.windowsamps)
-        self.chunk = eeg.eegsignals[:, range(startsamp, startsamp+self.windowsamps)]
-        snippet=self
+        self.chunk = eeg.window(startsamp, self.windowsamps)
+        if self.filtermode=='causal':
+            # only filter the samples that arrived since the last refresh
+            endsamp = startsamp+self.windowsamps
+            if endsamp > self.filteredcount:
+                newdata = self.filters.filter(eeg.window(self.filteredcount, endsamp-self.filteredcount))
+                nnew = min(newdata.shape[1], self.windowsamps)
+                self.filtered[:, :self.windowsamps-nnew] = self.filtered[:, nnew:]
+                self.filtered[:, self.windowsamps-nnew:] = newdata[:, newdata.shape[1]-nnew:]
+                self.filteredcount = endsamp
+        elif self.filtermode=='zerophase':
+            self.filtered = self.filters.filter(self.chunk)
+        elif self.filtermode=='prefiltered':
+            self.filtered = self.chunk
         self.curfbevent = self.nextfbevent
         self.nextfbevent += self.refreshsamps
         if self.nextfbevent >= eeg.nsamp:
@@ -28,61 +279,41 @@ class process:
         # targetchans is a list of chan indices we want to keep 
         # refchans is an array of reference channels to be subtracted where each target chan has its own list of refchans
         # weights has same size as refchans and defines the weighting of each reference channel
-        res = np.zeros((targetchans.shape[0],snippet.chunk.shape[1]))
-        if weights.shape[1]==0:
+        if weights.size==0:
             weights = np.zeros(refchans.shape) + (1/refchans.shape[1])
-            
-        for k in range( len(targetchans)):
-            res[k,:] = snippet.chunk[targetchans[k],:]
-            for k2 in range( refchans.shape[1]):
-                res[k,:] -= snippet.chunk[refchans[k,k2],:] * weights[k,k2]
-        return res
+        spatial = spatialfilter(snippet.chunk.shape[0], targetchans, refchans, weights, 'reference')
+        return spatial.matrix @ snippet.chunk
     
     def fftpowamp(signal:np.array,srate,targetfreqs):
-        p = np.zeros(len(targetfreqs))
-        if len(targetfreqs)==1:
-            fres = 1
-        else:
-            fres = max(0.05, min(1,min(np.diff(targetfreqs))))
-        n = round(srate/fres)
-        window = np.hamming(signal.shape[1]) 
-        freqs = np.fft.fftfreq(n, 1 / srate) 
-        signaltapered = signal*window
-        
-        fft_values = fft(signaltapered , n)
-        power = np.abs(fft_values)**2
-    
-        for k in range(len(targetfreqs)):
-            idx = np.where(np.isclose(freqs, targetfreqs[k], atol=fres/2))[0]
-            p[k] = np.log(power[0,idx]) 
-        return p
+        # log power at the target frequencies of the first channel
+        plan = spectralplan.get(signal.shape[1], srate, targetfreqs)
+        return plan.logpower(signal)[0]
     
+    def designfilter(order:int,cutoff,srate:float,btype:str,output:str='ba'):
+        # filter coefficients only depend on the parameters, so we design them once
+        return _designfilter(order, tuple(np.atleast_1d(cutoff).tolist()), float(srate), btype, output)
+
     def highpassfilter(signal,cutoff:float,srate:float):
-        b, a = scipy.signal.butter(3, cutoff / (0.5 * srate), btype='high')                
-        filtered_data = np.zeros(signal.shape)
-        for ch in range(signal.shape[0]):
-            filtered_data[ch,:] = scipy.signal.filtfilt( b, a, signal[ch,:],padtype='odd')
-        return filtered_data
+        b, a = process.designfilter(3, cutoff, srate, 'high')
+        return scipy.signal.filtfilt( b, a, signal, axis=1, padtype='odd')
     
     def notchfilter(signal,cutoff:tuple,srate:float):
-        b, a = scipy.signal.butter(2, cutoff / (0.5 * srate), btype='bandstop')                
-        filtered_data = np.zeros(signal.shape)
-        for ch in range(signal.shape[0]):
-            filtered_data[ch,:] = scipy.signal.filtfilt( b, a, signal[ch,:],padtype='odd')
-        return filtered_data
+        b, a = process.designfilter(2, cutoff, srate, 'bandstop')
+        return scipy.signal.filtfilt( b, a, signal, axis=1, padtype='odd')
     def bandpassfilter(signal,cutoff:tuple,srate:float):
-        b, a = scipy.signal.butter(2, cutoff / (0.5 * srate), btype='bandpass')                
-        filtered_data = np.zeros(signal.shape)
-        for ch in range(signal.shape[0]):
-            filtered_data[ch,:] = scipy.signal.filtfilt( b, a, signal[ch,:],padtype='odd')
-        return filtered_data
+        b, a = process.designfilter(2, cutoff, srate, 'bandpass')
+        return scipy.signal.filtfilt( b, a, signal, axis=1, padtype='odd')
     
     def precheck(fbp,snippet:datasnippet,model):
         curdata = process.notchfilter(snippet.chunk, fbp.stopband, snippet.srate)
         curdata = process.bandpassfilter( curdata, np.array([0.5, 30]), snippet.srate)
         stddev = np.std(curdata,axis=1)
         goodchan = np.array(np.where(stddev[fbp.referencechans]<=model['badchanthresh'])[1])
-        isArtifact = np.any(np.abs(curdata[fbp.outcomechans,:])>model['artifactthresh'],axis=1)
+        if 'cleaning' in model: # amplitudes after removing the eog components (icacleaner)
+            outcomedata = np.reshape(model['cleaning'],(curdata.shape[0],-1))[fbp.outcomechans,:] @ curdata
+        else:
+            outcomedata = curdata[fbp.outcomechans,:]
+        isArtifact = np.any(np.abs(outcomedata)>model['artifactthresh'],axis=1)
         isArtifact = isArtifact or max(goodchan.shape)<2
         return isArtifact,goodchan
     
@@ -97,6 +328,18 @@ class protocol:
         self.refweights = []        
         self.stopband = ()
         self.highpass = []
+        self.montage = 'reference'
+        self.spatial = None
+
+    def getspatialfilter(self):
+        # built on first use, such that the montage parameters can be changed before
+        if self.spatial is None:
+            self.spatial = spatialfilter(len(self.chanlist), self.outcomechans, self.referencechans, self.refweights, self.montage)
+        return self.spatial
+
+    def filterstages(self):
+        # filters applied to the outcome signal as (order, cutoff, btype)
+        return [(2, self.stopband, 'bandstop'), (3, self.highpass, 'high')]
         
 
 class frontaltheta(protocol):
@@ -110,11 +353,20 @@ class frontaltheta(protocol):
         self.artifactcolor = (100,100,100) # color shown when artifact is detected
         self.sendartifactfb = False
         self.detectartifacts = False
+        # train fits an icacleaner, process removes the flagged eog components whenever
+        # the model has a cleaning matrix (models without one give the same feedback as before)
+        self.removeartifacts = True
+        self.eogchans = ['Fpz','F7','F8'] # closest to the eyes
+        self.icasamples = 20 # the ica is only fitted on more than icasamples*nchan**2 samples
         self.outcomechans = np.array([1]) # Fz is second channel
         self.referencechans = np.array([np.setdiff1d( np.arange(len(self.chanlist)), self.outcomechans)])
         self.refweights = np.array(np.zeros(self.referencechans.shape) + (1/self.referencechans.shape[1]))
         self.stopband = np.array([42.5,57.5])
         self.highpass = 0.5
+        # 'none' uses Fz as it is; the re-referenced signal (montage 'reference') was
+        # computed but not used so far, so this keeps the feedback signal unchanged
+        self.montage = 'none'
+        self.spatial = None
         self.targetfrequencies = [4,5,6]
         # stucture that stores the outcome
         self.outcome = nfdata.fbdata()
@@ -123,6 +375,13 @@ class frontaltheta(protocol):
         self.high_edge = -1 #  
         self.prev_feedback = 0.5
         self.feedbackvalue = 0.5
+        self.edgewiden = 30 # an edge moves out by 1/edgewiden of the edge distance when feedback saturates
+        self.edgenarrow = 100 # otherwise it moves in by 1/edgenarrow of the edge distance
+        self.maxstep = 0.05 # max change of the feedback value between events
+        # optional nflatency.latencymonitor that times the processing steps
+        self.monitor = None
+        # timestamps of the outcome in sec of data instead of wall clock (replay)
+        self.datatime = False
 
     def apply( self, amplitude):
         # Calculate the feedback value based on the algorithm Brandmeyer et al. 2020
@@ -134,19 +393,19 @@ class frontaltheta(protocol):
         # Adjust edges based on the feedback value
         if feedback < 0:
             feedback = 0
-            self.low_edge = self.low_edge - (self.high_edge - self.low_edge) / 30
+            self.low_edge = self.low_edge - (self.high_edge - self.low_edge) / self.edgewiden
         else:
-            self.low_edge = self.low_edge + (self.high_edge - self.low_edge) / 100
+            self.low_edge = self.low_edge + (self.high_edge - self.low_edge) / self.edgenarrow
 
         if feedback > 1:
             feedback = 1
-            self.high_edge = self.high_edge + (self.high_edge - self.low_edge) / 30
+            self.high_edge = self.high_edge + (self.high_edge - self.low_edge) / self.edgewiden
         else:
-            self.high_edge = self.high_edge - (self.high_edge - self.low_edge) / 100
+            self.high_edge = self.high_edge - (self.high_edge - self.low_edge) / self.edgenarrow
 
         # Cap the feedback change
-        if abs(feedback - self.prev_feedback) > 0.05:
-            feedback = self.prev_feedback + 0.05 * np.sign(feedback - self.prev_feedback)
+        if abs(feedback - self.prev_feedback) > self.maxstep:
+            feedback = self.prev_feedback + self.maxstep * np.sign(feedback - self.prev_feedback)
 
         self.prev_feedback = feedback
         return feedback
@@ -164,17 +423,29 @@ class frontaltheta(protocol):
         else:
             hasArtifact=False
             goodchans=np.arange(self.referencechans.shape[1])
-        signal = process.rereference(snippet,self.outcomechans,self.referencechans[:,goodchans],self.refweights[:,goodchans])
-        signal =np.array([snippet.chunk[1,:]]) 
-        # filter
-        signal = process.notchfilter( signal,self.stopband,snippet.srate)
-        signal = process.highpassfilter(signal,self.highpass, snippet.srate)
+        spatial = self.getspatialfilter()
+        spatial.update(goodchans) # only rebuilds the matrix if the good channels changed
+        spatial.setcleaning(model.get('cleaning')) # only composed again for a new model
+        if snippet.filtermode=='window':
+            signal = spatial.apply(snippet.chunk)
+            # filter
+            signal = process.notchfilter( signal,self.stopband,snippet.srate)
+            signal = process.highpassfilter(signal,self.highpass, snippet.srate)
+        else: # already filtered by the filterbank of the snippet
+            signal = spatial.apply(snippet.filtered)
+        if self.monitor is not None: self.monitor.mark('filter')
         # frequency decomposition
         amplitudes = process.fftpowamp( signal,snippet.srate, self.targetfrequencies)
         amplitude = np.mean(amplitudes)
+        if self.monitor is not None: self.monitor.mark('spectral')
         if hasArtifact==False:
             self.feedbackvalue = self.apply(amplitude)
-        self.outcome.adddata(snippet.curfbevent,amplitude,self.feedbackvalue, self.low_edge, self.high_edge, time.time()-self.starttime)
+        if self.monitor is not None: self.monitor.mark('apply')
+        if self.datatime:
+            tstamp = snippet.curfbevent/snippet.srate
+        else:
+            tstamp = time.time()-self.starttime
+        self.outcome.adddata(snippet.curfbevent,amplitude,self.feedbackvalue, self.low_edge, self.high_edge, tstamp)
         if savePreprocessed:
             self.outcome.addpreprocdata(signal)
         return success
@@ -182,27 +453,46 @@ class frontaltheta(protocol):
     def train( self, eeg:nfdata.rawdata):
         model = {'loweredge':0,'upperedge':0,'artifactthresh':100, 'badchanthresh':100}
         
-        data = process.notchfilter(eeg.eegsignals, self.stopband, eeg.srate)
+        data = process.notchfilter(eeg.recorded(), self.stopband, eeg.srate)
         data = process.bandpassfilter( data, np.array([0.5, 30]),eeg.srate)
         
-        # iterate across data
+        # ica of the calibration data, the eog components are removed during feedback
+        cleaning = None
+        minsamples = self.icasamples*data.shape[0]**2
+        if self.removeartifacts and data.shape[1] <= minsamples:
+            print('warning: %d samples are too few for the ica (more than %d needed), artifacts are not removed'
+                  % (data.shape[1], minsamples))
+        elif self.removeartifacts:
+            eogchans = [self.chanlist.index(chan) for chan in self.eogchans if chan in self.chanlist]
+            cleaner = icacleaner().fit(data, eogchans)
+            cleaning = cleaner.matrix
+            model['cleaning'] = cleaning
+            model['unmixing'] = cleaner.unmixing
+            model['badcomponents'] = cleaner.badcomponents
+            print('removing %d of %d ica components' % (len(cleaner.badcomponents), len(cleaner.unmixing)))
+        
+        # all windows as a strided view (channels x windows x samples), nothing is copied
         windowsamp = round(self.windowwidth*eeg.srate)
-        onsets = np.arange(0,data.shape[1]-windowsamp,round(0.5*windowsamp))
-        stddevs = np.zeros([data.shape[0],len(onsets)])
-        for k in range(len(onsets)):
-            curdat = data[:,range(onsets[k],onsets[k]+windowsamp)]
-            stddevs[:,k] = np.std(curdat, axis=1)
+        step = round(0.5*windowsamp)
+        onsets = np.arange(0,data.shape[1]-windowsamp,step)
+        windows = np.lib.stride_tricks.sliding_window_view(data,windowsamp,axis=1)[:,::step,:][:,:len(onsets),:]
+        stddevs = np.std(windows,axis=2)
         medianstddevs = np.median(stddevs,axis=1)
         model['badchanthresh'] = np.median(medianstddevs)*4
-        model['artifactthresh'] = medianstddevs[self.outcomechans]*4
-        # calculate the amplitudes to estimate edges
-        amplist = []
-        snippet = datasnippet(self,eeg.srate)
-        for k in range(len(onsets)):
-            snippet.chunk = data[:,range(onsets[k],onsets[k]+windowsamp)]
-            snippet.curfbevent = onsets[k]          
-            self.process(snippet,model)
-        amps = np.array(self.outcome.amplitude )            
+        if cleaning is not None: # precheck looks at the cleaned outcome channels
+            outcomedata = cleaning[self.outcomechans,:] @ data
+            windows = np.lib.stride_tricks.sliding_window_view(outcomedata,windowsamp,axis=1)[:,::step,:][:,:len(onsets),:]
+            model['artifactthresh'] = np.median(np.std(windows,axis=2),axis=1)*4
+        else:
+            model['artifactthresh'] = medianstddevs[self.outcomechans]*4
+        # calculate the amplitudes of all windows at once to estimate edges
+        # (data is already filtered, the outcome and feedback state are left untouched)
+        spatial = self.getspatialfilter()
+        spatial.update(np.arange(self.referencechans.shape[1]))
+        spatial.setcleaning(cleaning)
+        signal = spatial.matrix[0,:] @ data
+        plan = spectralplan.get(windowsamp, eeg.srate, self.targetfrequencies)
+        amps = np.mean(plan.logpower(np.lib.stride_tricks.sliding_window_view(signal,windowsamp)[::step][:len(onsets)]),axis=1)
         stddev= np.std(amps)
         mean = np.mean(amps)         
         model['loweredge']= np.max((np.min(amps),mean-stddev*0.95))
@@ -0,0 +1,55 @@
+import nfdata
+import nfprocess
+import scipy.io
+import argparse
+import os, time
+
+# runs the feedback protocol over recorded sessions as fast as possible
+# the snippets and the protocol state evolve exactly as in nfrun, only the
+# timestamps of the outcome are given in sec of data instead of wall clock
+
+def replay(eeg:nfdata.rawdata, fbp, model:dict, filtermode:str='causal'):
+    fbp.datatime = True
+    snippet = nfprocess.datasnippet(fbp,eeg.srate,filtermode)
+    if fbp.outcome.count==0:
+        fbp.outcome = nfdata.fbdata(round(eeg.sampcount/eeg.srate/fbp.fbrefresh)+1)
+    while eeg.sampcount > snippet.nextfbevent:
+        event = snippet.nextfbevent
+        snippet.refresh(eeg)
+        fbp.process(snippet,model)
+        if snippet.nextfbevent == event: # reached the end of the data
+            break
+    return fbp.outcome
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded NeuroFeedback sessions")
+    parser.add_argument('sessions', type=str, nargs='+', help='Recorded runs (.mat) or BrainVision files (.vhdr)')
+    parser.add_argument('-m', '--model', type=str, help='Model file (default model if not given)')
+    parser.add_argument('-F', '--filtermode', type=str, help='Filter Mode (causal(default), zerophase or window)')
+    parser.add_argument('-o', '--outputpath', type=str, help='Where to store the outcome (default next to the session)')
+    args = parser.parse_args()
+
+    prm = nfdata.params()
+    if args.filtermode:
+        prm.filtermode = args.filtermode
+    if args.model:
+        model = nfdata.io.loadmodel(args.model)
+    else:
+        model = {'artifactthresh':1000,'badchanthresh':1000,'loweredge':-1,'upperedge':-1}
+
+    for session in args.sessions:
+        if prm.fbprotocol=="frontaltheta":
+            fbp = nfprocess.frontaltheta()
+        eeg = nfdata.io.loadsession(session,fbp.chanlist)
+        starttime = time.time()
+        outcome = replay(eeg,fbp,model,prm.filtermode)
+        duration = time.time()-starttime
+        print('%s: %d feedback events, %.1f s of data in %.2f s'
+              % (session, len(outcome.position), eeg.sampcount/eeg.srate, duration))
+        filename = os.path.splitext(session)[0] + '_replay.mat'
+        if args.outputpath:
+            filename = os.path.join(args.outputpath, os.path.basename(filename))
+        scipy.io.savemat(filename, nfdata.io.prepareoutcome4mat(outcome))
+
+if __name__ == "__main__":
+    main()
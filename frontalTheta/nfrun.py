@@ -1,6 +1,8 @@
 import nfcomm 
 import nfdata
 import nfprocess
+import nfpipeline
+import nflatency
 import scipy.io
 import argparse
 
@@ -11,6 +13,15 @@ def main():
     parser.add_argument('-p', '--pretrainedmodel', type=dict, help='Pretrained Model') 
     parser.add_argument('-f', '--samplingrate', type=int, help='Sampling Frequency')
     parser.add_argument('-d', '--runlength', type=int, help='Duration of a Run')
+    parser.add_argument('-F', '--filtermode', type=str, help='Filter Mode (causal(default), zerophase or window)')
+    parser.add_argument('-b', '--bufferlength', type=int, help='Length of the ring buffer in sec (0 keeps the whole run in memory)')
+    parser.add_argument('-P', '--pipeline', action='store_true', help='Run acquisition, feedback and recording in separate processes')
+    parser.add_argument('-S', '--source', type=str, help='Data source (lsl(default), f1 or sim)')
+    parser.add_argument('--scenario', type=str, help='Scenario of the simulated data (see nfsim.scenarios)')
+    parser.add_argument('--seed', type=int, help='Seed of the simulated data')
+    parser.add_argument('--speed', type=float, help='Speed of the simulated data (1 real time, 0 as fast as possible)')
+    parser.add_argument('-T', '--tap', type=str, help='Publish the data in shared memory under this name (for nfshowsignals --shm)')
+    parser.add_argument('--tapfiltered', action='store_true', help='Also publish the filtered data')
     args = parser.parse_args() 
     if args.mode: 
         mode = args.mode
@@ -32,7 +43,7 @@ def main():
         runlength = prm.nfrunlength
         # load model data
         try:
-            model = scipy.io.loadmat(modelfilename)            
+            model = nfdata.io.loadmodel(modelfilename)
         except Exception as e:
             print(f"Error: {e}")
             print(f"Using default model. Please make sure that the model file exists.")
@@ -46,12 +57,37 @@ def main():
         srate = prm.srate
     if args.runlength:
         runlength = args.runlength
+    if args.filtermode:
+        prm.filtermode = args.filtermode
+    if args.bufferlength:
+        prm.bufferlength = args.bufferlength
+    if args.source:
+        prm.source = args.source
+    if args.scenario:
+        prm.simscenario = args.scenario
+    if args.seed is not None:
+        prm.simseed = args.seed
+    if args.speed is not None:
+        prm.simspeed = args.speed
+    if args.tap:
+        prm.tapname = args.tap
+        prm.tapfiltered = args.tapfiltered
     
+    if args.pipeline:
+        if prm.fbprotocol=="frontaltheta":
+            chanlist = nfprocess.frontaltheta().chanlist
+        if mode != "nf":
+            model = dict()
+        print('Starting pipelined %s run of duration %d s at %d Hz.' %(mode, runlength, srate))
+        nfpipeline.run(mode, model, modelfilename, nfdata.io.generatefilename(prm,subjcode), prm, chanlist, srate, runlength)
+        print("Run finished.")
+        return
  
 
     if prm.fbmodule=="blueSquareUDP":
         fbm = nfcomm.udpfeedback()
         fbm.connect()
+        fbm.listenreports()
     # todo: add other modules
 
     if prm.fbprotocol=="frontaltheta":
@@ -63,12 +99,20 @@ def main():
     if debuglevel==1: print(fbp.chanlist)
 
     # eeg data structure
-    eeg = nfdata.rawdata(len(fbp.chanlist), round( srate*runlength))
+    eeg = nfdata.rawdata(len(fbp.chanlist), round( srate*runlength), round( srate*prm.bufferlength))
     eeg.srate = srate
+    filename = nfdata.io.generatefilename(prm,subjcode)
+    # the data is written to disk while the run goes on
+    recorder = nfdata.sessionrecorder(filename.replace('.mat','.nfs'),fbp.chanlist,srate)
+    eeg.record(recorder)
 
 
-    lsl = nfcomm.lslreader(fbp.chanlist)
+    lsl = nfcomm.eegreader(prm,fbp.chanlist,srate)
     lsl.connect()   
+    tap = None
+    if prm.tapname: # display processes look at the same data
+        filters = nfprocess.filterbank(len(fbp.chanlist), srate, fbp.filterstages()) if prm.tapfiltered else None
+        tap = nfdata.shmtap(prm.tapname, len(fbp.chanlist), srate, round(srate*prm.taplength), filters)
     
     print('Starting %s run of duration %d ms at %d Hz.' %(mode, runlength, srate))
     print('User ID is %s' %(subjcode))
@@ -78,40 +122,66 @@ def main():
               % (model['loweredge'] , model['upperedge'] ,
                  model['artifactthresh'] , model['badchanthresh']))
         
-    snippet = nfprocess.datasnippet(fbp,srate)
+    snippet = nfprocess.datasnippet(fbp,srate,prm.filtermode)
+    fbp.outcome = nfdata.fbdata(round(runlength/fbp.fbrefresh)+1)
+    fbp.monitor = nflatency.latencymonitor(round(runlength/fbp.fbrefresh)+1,prm.latencyport)
     print("Reading data ...")
+    lastevent = -1
     while eeg.sampcount < eeg.nsamp:
-        # grab new data
-        chunk = lsl.readdata()
+        # grab new data (waits for samples instead of polling)
+        chunk, timestamps = lsl.readinto()
         if len(chunk.shape)==2 and chunk.shape[1]>0:
-            eeg.adddata( chunk)
-        # check whether we have enaough new data grabbed
-        if eeg.sampcount > snippet.nextfbevent:
+            eeg.adddata( chunk, timestamps)
+            if tap is not None:
+                tap.write( chunk, timestamps)
+        # process every event that is due, a chunk can span several feedback steps
+        while eeg.sampcount > snippet.nextfbevent and snippet.nextfbevent != lastevent:
+            lastevent = snippet.nextfbevent # the last event stays at the end of the data
             if mode=="nf": # we only process the data in nf mode
+                fbp.monitor.start(eeg.timewindow(snippet.nextfbevent-1,1)[0])
                 snippet.refresh( eeg) # copies data from buffer to snippet            
                 success = fbp.process( snippet, model)
                 if success <0 and fbp.sendartifactfb:
                     fbm.sendcolor(fbp.artifactcolor)
                 else:
                     fbm.sendfeedback( fbp.feedbackvalue)
+                fbp.monitor.mark('send')
+                fbp.monitor.stop()
+                recorder.addevents(fbp.outcome)
+                fbm.readreports()
+            else:
+                snippet.nextfbevent = eeg.sampcount
     if mode[0] == "c": # calibration
         model = fbp.train(eeg)
     else:
         model['loweredge'] = fbp.low_edge
         model['upperedge'] = fbp.high_edge
         
+    lsl.close()
     # hide the square
     fbm.sendcolor((0,0,0))
+    fbm.readreports()
+    fbp.monitor.display = fbm.reportdict()
+    fbm.close()
+    if tap is not None:
+        tap.close()
     # save the model
     scipy.io.savemat(modelfilename,model)
     
     # finalize
     outcome = fbp.outcome       
 
-    # save the data
-    data = nfdata.io.preparedata4mat(eeg,outcome)
-    filename = nfdata.io.generatefilename(prm,subjcode)
-    scipy.io.savemat(filename, data)
+    # finish the recording
+    recorder.addevents(outcome)
+    if prm.legacymat:
+        recorder.finalize(filename, {'preprocdata':outcome.preprocdata})
+    else:
+        recorder.finalize()
+    eeg.close()
+    if fbp.monitor.count>0:
+        scipy.io.savemat(filename.replace('.mat','_latency.mat'), fbp.monitor.todict())
+        print(fbp.monitor.report())
+    fbp.monitor.close()
                     
     if debuglevel==1:
         print(eeg.sampcount)
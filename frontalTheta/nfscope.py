@@ -0,0 +1,82 @@
+import numpy as np
+import pygame
+
+class scope:
+    # sweeping multichannel eeg display on a pygame surface
+    # each chunk is turned into one polyline per channel in a single vectorized step and
+    # only the columns that changed are cleared and redrawn (returned as dirty rects)
+    # with more than one sample per pixel column the min/max of each column is drawn,
+    # so no peak gets lost and the number of points does not grow with the sampling rate
+    def __init__(self,surface,nchan:int,rect=None,samplesperpixel:int=1,scale:float=1.0,
+                 color=(0,255,0),background=(0,0,0),gap:int=4):
+        self.surface = surface
+        self.rect = pygame.Rect(rect) if rect is not None else surface.get_rect()
+        self.nchan = nchan
+        self.samplesperpixel = max(1,int(samplesperpixel))
+        self.scale = scale
+        self.color = color
+        self.background = background
+        self.gap = gap # blank columns ahead of the sweep
+        chanheight = self.rect.height // nchan
+        self.centers = self.rect.top + chanheight*np.arange(nchan) + chanheight//2
+        self.baseline = np.zeros(nchan)
+        self.col = 0 # next pixel column of the sweep
+        self.prev = None # y of the last drawn point of each channel
+        self.pending = np.zeros((nchan,0)) # samples of an incomplete pixel column
+
+    def columns(self,data:np.array):
+        # min and max of each complete pixel column (channels x columns)
+        if self.samplesperpixel==1:
+            return data, data
+        data = np.concatenate((self.pending,data),axis=1)
+        ncol = data.shape[1] // self.samplesperpixel
+        self.pending = data[:, ncol*self.samplesperpixel:]
+        blocks = data[:, :ncol*self.samplesperpixel].reshape((self.nchan,ncol,self.samplesperpixel))
+        return blocks.min(axis=2), blocks.max(axis=2)
+
+    def clear(self):
+        self.surface.fill(self.background,self.rect)
+        self.col = 0
+        self.prev = None
+        return [self.rect]
+
+    def draw(self,data:np.array):
+        # data is channels x samples, returns the rects that need a display update
+        lo, hi = self.columns(np.asarray(data)*self.scale)
+        ncol = lo.shape[1]
+        dirty = list()
+        oldclip = self.surface.get_clip()
+        self.surface.set_clip(self.rect)
+        start = 0
+        while start < ncol:
+            n = min(ncol-start, self.rect.width-self.col)
+            if self.col==0: # new sweep, center the channels again
+                self.baseline = self.centers - (lo[:,start]+hi[:,start])/2
+                self.prev = None
+            x = self.rect.left + self.col + np.arange(n)
+            # clear the columns to be drawn and a small gap ahead of the sweep
+            area = pygame.Rect(x[0], self.rect.top, n+self.gap, self.rect.height).clip(self.rect)
+            self.surface.fill(self.background,area)
+            ylo = (lo[:,start:start+n] + self.baseline[:,None]).astype(int)
+            yhi = (hi[:,start:start+n] + self.baseline[:,None]).astype(int)
+            if self.samplesperpixel==1:
+                xs = x
+                ys = yhi
+            else: # down and up in every column
+                xs = np.repeat(x,2)
+                ys = np.stack((ylo,yhi),axis=2).reshape((self.nchan,2*n))
+            if self.prev is not None: # connect to the previous chunk
+                xs = np.append(x[0]-1,xs)
+                ys = np.concatenate((self.prev[:,None],ys),axis=1)
+            for ch in range(self.nchan):
+                points = np.column_stack((xs,ys[ch,:]))
+                if len(points)>1:
+                    pygame.draw.lines(self.surface,self.color,False,points)
+                else:
+                    self.surface.set_at(tuple(points[0]),self.color)
+            self.prev = ys[:,-1]
+            dirty.append(area)
+            self.col = (self.col+n) % self.rect.width
+            start += n
+        self.surface.set_clip(oldclip)
+        return dirty
@@ -0,0 +1,375 @@
+import nfcomm
+import nfdata
+import nfprocess
+import nflatency
+import numpy as np
+import scipy.io
+import asyncio
+import argparse
+import copy, json, socket, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+# session engine: runs calibration and neurofeedback sessions in one process and is
+# controlled over a local socket with one json object per line, e.g.
+#   {"cmd": "start_nf", "subject": "s01"}      -> {"ok": true, "session": 1}
+#   {"cmd": "start_calibration", "subject": "s01", "runlength": 60}
+#   {"cmd": "stop", "session": 1}
+#   {"cmd": "status"}                           -> {"ok": true, "sessions": [...]}
+#   {"cmd": "subscribe", "interval": 0.5}       -> a status line every interval
+#   {"cmd": "shutdown"}
+# each session does its blocking work (reading samples, numpy, saving) in its own
+# worker thread, the event loop only sends the feedback and talks to the clients
+
+class reportprotocol(asyncio.DatagramProtocol):
+    # display reports (see nfcomm.udpfeedback.sendreport)
+    def __init__(self,fbm:nfcomm.udpfeedback):
+        self.fbm = fbm
+    def datagram_received(self,data,addr):
+        self.fbm.addreport(data)
+
+class session:
+    # the next run number is taken from the files on disk, so the sessions pick their
+    # filenames one after the other (the recorder creates its directory right away)
+    filelock = threading.Lock()
+
+    def __init__(self,sessionid:int,mode:str,subjcode:str,prm:nfdata.params,runlength:float=0,srate:int=0,fbport:int=0):
+        self.id = sessionid
+        self.mode = mode
+        self.subjcode = subjcode
+        self.prm = prm
+        if mode == "nf":
+            self.runlength = runlength if runlength else prm.nfrunlength
+        else:
+            self.runlength = runlength if runlength else prm.calibrunlength
+        self.srate = srate if srate else prm.srate
+        self.fbm = nfcomm.udpfeedback()
+        if fbport:
+            self.fbm.UDP_PORT = fbport
+            self.fbm.REPORT_PORT = fbport+1
+        self.executor = ThreadPoolExecutor(max_workers=1) # keeps the steps of a session in order
+        self.state = "created"
+        self.error = ""
+        self.stopping = False
+        self.starttime = 0
+        self.filename = ""
+        self.eeg = None
+        self.fbp = None
+        self.reader = None
+        self.recorder = None
+        self.tap = None
+
+    def setup(self):
+        # worker thread: everything nfrun does before the first sample
+        prm = self.prm
+        self.modelfilename = prm.datapath + f"{self.subjcode}_model.mat"
+        self.model = {'artifactthresh':1000,'badchanthresh':1000,'loweredge':-1,'upperedge':-1}
+        if self.mode == "nf":
+            try:
+                self.model = nfdata.io.loadmodel(self.modelfilename)
+            except Exception as e:
+                print(f"Error: {e}")
+                print("Using default model. Please make sure that the model file exists.")
+        if prm.fbprotocol=="frontaltheta":
+            self.fbp = nfprocess.frontaltheta()
+        fbp = self.fbp
+        self.eeg = nfdata.rawdata(len(fbp.chanlist), round(self.srate*self.runlength), round(self.srate*prm.bufferlength))
+        self.eeg.srate = self.srate
+        with session.filelock:
+            self.filename = nfdata.io.generatefilename(prm,self.subjcode)
+            self.recorder = nfdata.sessionrecorder(self.filename.replace('.mat','.nfs'),fbp.chanlist,self.srate)
+        self.eeg.record(self.recorder)
+        self.reader = nfcomm.eegreader(prm,fbp.chanlist,self.srate)
+        if self.reader.connect() != 0:
+            raise RuntimeError("no eeg stream")
+        if prm.tapname: # display processes look at the same data
+            filters = nfprocess.filterbank(len(fbp.chanlist), self.srate, fbp.filterstages()) if prm.tapfiltered else None
+            self.tap = nfdata.shmtap(prm.tapname, len(fbp.chanlist), self.srate, round(self.srate*prm.taplength), filters)
+        self.snippet = nfprocess.datasnippet(fbp,self.srate,prm.filtermode)
+        self.lastevent = -1 # the last event stays at the end of the data
+        nevents = round(self.runlength/fbp.fbrefresh)+1
+        fbp.outcome = nfdata.fbdata(nevents)
+        fbp.monitor = nflatency.latencymonitor(nevents,prm.latencyport)
+
+    def due(self):
+        # a feedback event can be computed from the data read so far
+        return self.mode=="nf" and self.eeg.sampcount > self.snippet.nextfbevent != self.lastevent
+
+    def step(self):
+        # worker thread: reads the next samples unless an event is still due (a chunk can
+        # span several feedback steps) and computes the feedback of one due event,
+        # returns the packet to send (or None)
+        eeg, fbp, snippet = self.eeg, self.fbp, self.snippet
+        if not self.due():
+            chunk, timestamps = self.reader.readinto()
+            if len(chunk.shape)==2 and chunk.shape[1]>0:
+                eeg.adddata(chunk, timestamps)
+                if self.tap is not None:
+                    self.tap.write(chunk, timestamps)
+        if self.due():
+            self.lastevent = snippet.nextfbevent
+            fbp.monitor.start(eeg.timewindow(snippet.nextfbevent-1,1)[0])
+            snippet.refresh(eeg)
+            success = fbp.process(snippet, self.model)
+            if success <0 and fbp.sendartifactfb:
+                return self.fbm.colorpacket(fbp.artifactcolor)
+            return self.fbm.feedbackpacket(fbp.feedbackvalue)
+        return None
+
+    def finish(self):
+        # worker thread: train or update the model and save everything as nfrun does
+        fbp = self.fbp
+        self.release(('reader','tap'))
+        if self.mode[0] == "c":
+            self.model = fbp.train(self.eeg)
+        else:
+            self.model['loweredge'] = fbp.low_edge
+            self.model['upperedge'] = fbp.high_edge
+        scipy.io.savemat(self.modelfilename,self.model)
+        self.recorder.addevents(fbp.outcome)
+        recorder, self.recorder = self.recorder, None
+        if self.prm.legacymat:
+            recorder.finalize(self.filename, {'preprocdata':fbp.outcome.preprocdata})
+        else:
+            recorder.finalize()
+        fbp.monitor.display = self.fbm.reportdict()
+        if fbp.monitor.count>0:
+            scipy.io.savemat(self.filename.replace('.mat','_latency.mat'), fbp.monitor.todict())
+        fbp.monitor.close()
+
+    def release(self,names=('reader','tap','recorder','eeg')):
+        # worker thread: closes what is still open, also after an error; each resource on
+        # its own, such that one failing close does not leave the others open
+        # (the tap is unlinked by close, the recorder keeps the data recorded so far)
+        for name in names:
+            resource = getattr(self,name)
+            if resource is None:
+                continue
+            if name != 'eeg': # metrics still look at the samples of eeg
+                setattr(self,name,None)
+            try:
+                if name == 'recorder':
+                    resource.finalize()
+                else:
+                    resource.close()
+            except Exception as e:
+                print(f"Error closing the {name} of session {self.id}: {e}")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        transport = reports = None
+        try:
+            self.state = "connecting"
+            await loop.run_in_executor(self.executor, self.setup)
+            transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol,
+                                                               remote_addr=(self.fbm.UDP_IP,self.fbm.UDP_PORT))
+            try:
+                reports, _ = await loop.create_datagram_endpoint(lambda: reportprotocol(self.fbm),
+                                                                 local_addr=(self.fbm.UDP_IP,self.fbm.REPORT_PORT))
+            except OSError as e:
+                print(f"Error: {e}, display reports are not recorded")
+            transport.sendto(self.fbm.colorpacket(self.fbp.startcolor))
+            self.state = "running"
+            self.starttime = time.time()
+            while not self.stopping and (self.eeg.sampcount < self.eeg.nsamp or self.due()):
+                packet = await loop.run_in_executor(self.executor, self.step)
+                if packet is not None:
+                    transport.sendto(packet)
+                    self.fbp.monitor.mark('send')
+                    self.fbp.monitor.stop()
+                    self.recorder.addevents(self.fbp.outcome)
+            transport.sendto(self.fbm.colorpacket((0,0,0))) # hide the square
+            self.state = "saving"
+            await loop.run_in_executor(self.executor, self.finish)
+            self.state = "stopped" if self.stopping else "finished"
+        except Exception as e:
+            self.state = "error"
+            self.error = str(e)
+            if transport is not None: # hide the square
+                transport.sendto(self.fbm.colorpacket((0,0,0)))
+        finally:
+            for t in (transport,reports):
+                if t is not None:
+                    t.close()
+            try:
+                await loop.run_in_executor(self.executor, self.release)
+            finally:
+                self.executor.shutdown(wait=False)
+
+    def stop(self):
+        # ends the session early, the data recorded so far are saved
+        self.stopping = True
+
+    def metrics(self):
+        status = {'session':self.id,'mode':self.mode,'subject':self.subjcode,'state':self.state,
+                  'runlength':self.runlength,'filename':self.filename}
+        if self.error:
+            status['error'] = self.error
+        if self.eeg is not None:
+            status['seconds'] = self.eeg.sampcount/self.srate
+        if self.fbp is not None and self.fbp.monitor is not None:
+            fbp = self.fbp
+            status['events'] = fbp.outcome.count
+            if fbp.outcome.count>0:
+                status['feedback'] = float(fbp.outcome.feedbackvalue[-1])
+                status['amplitude'] = float(fbp.outcome.amplitude[-1])
+                status['loweredge'] = float(fbp.low_edge)
+                status['upperedge'] = float(fbp.high_edge)
+                status['latency'] = float(np.nanmedian(fbp.monitor.times[:fbp.monitor.count,-1]))
+            status['displaydropped'] = self.fbm.reports[-1][4] if self.fbm.reports else 0
+        return status
+
+class engine:
+    def __init__(self,prm:nfdata.params=None):
+        self.prm = prm if prm is not None else nfdata.params()
+        self.sessions = dict()
+        self.nextid = 1
+        self.done = None
+        self.writers = set() # open client connections
+        # sessions get their own feedback ports (fbport and fbport+1 for the display reports)
+        # and tap, such that sessions running at the same time do not collide
+        self.fbportbase = 2000
+
+    def start(self,mode:str,request:dict):
+        prm = copy.copy(self.prm)
+        for key in ('filtermode','source','bufferlength','tapfiltered','simscenario','simseed','simspeed'):
+            if key in request:
+                setattr(prm,key,request[key])
+        sessionid = self.nextid
+        if request.get('tap') or request.get('tapname'): # the name is a prefix, e.g. nftap -> nftap3
+            prm.tapname = "%s%d" % (request.get('tapname') or "nftap", sessionid)
+        else:
+            prm.tapname = ""
+        fbport = request.get('fbport') or self.fbportbase+2*sessionid
+        s = session(sessionid, mode, request.get('subject','test'), prm,
+                    request.get('runlength',0), request.get('srate',0), fbport)
+        self.nextid += 1
+        self.sessions[s.id] = s
+        s.task = asyncio.get_running_loop().create_task(s.run())
+        return {'ok':True,'session':s.id,'tapname':prm.tapname,'fbport':fbport}
+
+    def status(self,request:dict):
+        if 'session' in request:
+            return {'ok':True,'sessions':[self.sessions[request['session']].metrics()]}
+        return {'ok':True,'sessions':[s.metrics() for s in self.sessions.values()]}
+
+    async def subscribe(self,writer,interval:float):
+        # streams the status of all sessions until the client disconnects
+        while not writer.is_closing():
+            message = self.status({})
+            message['event'] = 'status'
+            writer.write((json.dumps(message)+"\n").encode())
+            await asyncio.sleep(interval)
+
+    async def command(self,request:dict,writer):
+        cmd = request.get('cmd')
+        try:
+            if cmd == 'start_calibration':
+                return self.start('calib',request)
+            if cmd == 'start_nf':
+                return self.start('nf',request)
+            if cmd == 'stop':
+                ids = [request['session']] if 'session' in request else list(self.sessions.keys())
+                for sessionid in ids:
+                    self.sessions[sessionid].stop()
+                return {'ok':True}
+            if cmd == 'status':
+                return self.status(request)
+            if cmd == 'subscribe':
+                asyncio.get_running_loop().create_task(self.subscribe(writer,request.get('interval',1.0)))
+                return {'ok':True}
+            if cmd == 'shutdown':
+                for s in self.sessions.values():
+                    s.stop()
+                self.done.set()
+                return {'ok':True}
+        except KeyError as e:
+            return {'ok':False,'error':f"unknown session {e}"}
+        return {'ok':False,'error':f"unknown command {cmd}"}
+
+    async def handle(self,reader,writer):
+        # one client connection, one json request per line
+        self.writers.add(writer)
+        try:
+            while not reader.at_eof():
+                line = await reader.readline()
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    reply = await self.command(request,writer)
+                except json.JSONDecodeError as e:
+                    reply = {'ok':False,'error':str(e)}
+                writer.write((json.dumps(reply)+"\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def serve(self,host:str="127.0.0.1",port:int=1980):
+        self.done = asyncio.Event()
+        server = await asyncio.start_server(self.handle,host,port)
+        print("Session engine listening on %s:%d" % (host,port))
+        async with server:
+            await self.done.wait()
+            for writer in list(self.writers): # ends the client handlers
+                writer.close()
+        # let the running sessions save their data
+        tasks = [s.task for s in self.sessions.values()]
+        if tasks:
+            await asyncio.gather(*tasks)
+
+class client:
+    # blocking client for the gui or scripts
+    def __init__(self,host:str="127.0.0.1",port:int=1980,timeout:float=5.0):
+        self.sock = socket.create_connection((host,port),timeout)
+        self.file = self.sock.makefile('rw')
+    def request(self,cmd:str,**kwargs):
+        kwargs['cmd'] = cmd
+        self.file.write(json.dumps(kwargs)+"\n")
+        self.file.flush()
+        while True:
+            reply = json.loads(self.file.readline())
+            if reply.get('event') != 'status': # skip streamed status lines
+                return reply
+    def messages(self):
+        # streamed status lines after request('subscribe')
+        self.sock.settimeout(None)
+        for line in self.file:
+            yield json.loads(line)
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="NeuroFeedback session engine")
+    parser.add_argument('-p', '--port', type=int, default=1980, help='Control port on localhost (default 1980)')
+    parser.add_argument('-c', '--command', type=str, help='Send a command to a running engine (e.g. start_nf, stop, status)')
+    parser.add_argument('-s', '--subjectcode', type=str, help='Subject Code (with -c start_nf or start_calibration)')
+    parser.add_argument('-i', '--session', type=int, help='Session (with -c stop or status)')
+    parser.add_argument('-d', '--runlength', type=int, help='Duration of a Run')
+    parser.add_argument('--follow', action='store_true', help='Print the status of the sessions until interrupted')
+    args = parser.parse_args()
+
+    if not args.command and not args.follow:
+        asyncio.run(engine().serve(port=args.port))
+        return
+    c = client(port=args.port)
+    if args.command:
+        request = dict()
+        if args.subjectcode:
+            request['subject'] = args.subjectcode
+        if args.session:
+            request['session'] = args.session
+        if args.runlength:
+            request['runlength'] = args.runlength
+        print(json.dumps(c.request(args.command,**request)))
+    if args.follow:
+        c.request('subscribe',interval=1.0)
+        for message in c.messages():
+            print(json.dumps(message['sessions']))
+    c.close()
+
+if __name__ == "__main__":
+    main()
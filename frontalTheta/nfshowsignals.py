@@ -1,7 +1,14 @@
 import numpy as np
 import pygame
-import nfcomm, nfdata, nfprocess
-from pylsl import StreamInlet, resolve_stream, TimeoutError
+import argparse
+import nfcomm, nfdata, nfprocess, nfscope
+
+parser = argparse.ArgumentParser(description="Show EEG Signals")
+parser.add_argument('-t', '--timespan', type=float, help='Seconds per sweep (default one sample per pixel)')
+parser.add_argument('-f', '--samplingrate', type=int, help='Sampling Frequency')
+parser.add_argument('--shm', type=str, help='Show the data a run publishes under this name (nfrun -T) instead of reading lsl')
+parser.add_argument('--filtered', action='store_true', help='Show the filtered data of the run (needs nfrun --tapfiltered)')
+args = parser.parse_args()
 
 # Initialize Pygame
 pygame.init()
@@ -14,21 +21,52 @@ pygame.display.set_caption("EEG Signal Display")
 # some parameters
 prm = nfdata.params()
 prm.srate = 250
+if args.samplingrate:
+    prm.srate = args.samplingrate
 scale = 0.2 # we might scale the values differnetly depending on the device
 
 if prm.fbprotocol=="frontaltheta":
     fbp = nfprocess.frontaltheta()
 
-lsl = nfcomm.lslreader(fbp.chanlist)
-lsl.connect()
+if args.shm:
+    # attach to the data of the run, no lsl inlet of our own
+    tapname = args.shm + ("_filtered" if args.filtered else "")
+    tap = None
+    tapcount = 0
+else:
+    lsl = nfcomm.lslreader(fbp.chanlist)
+    lsl.connect()
+
+def readtap():
+    # new samples of the run, attaches (again) when a run starts
+    global tap, tapcount
+    if tap is not None and tap.closed:
+        tap.close()
+        tap = None
+    if tap is None:
+        try:
+            tap = nfdata.shmring(tapname, readonly=True)
+        except FileNotFoundError:
+            return None
+        if tap.closed: # previous run, not removed yet
+            tap.close()
+            tap = None
+            return None
+        tapcount = tap.sampcount
+    start, data = tap.latest(tapcount, screen_width*samplesperpixel)
+    tapcount = start + data.shape[1]
+    return data if data.shape[1]>0 else None
+
+# more samples than pixels per sweep are decimated to min/max per pixel column
+samplesperpixel = 1
+if args.timespan:
+    samplesperpixel = int(np.ceil(args.timespan*prm.srate/screen_width))
+display = nfscope.scope(screen, len(fbp.chanlist), samplesperpixel=samplesperpixel, scale=scale)
+pygame.display.update(display.clear())
 
 # Main loop with feedback implementation
 running = True
 clock = pygame.time.Clock()
-channel_height = screen_height // len(fbp.chanlist)  # Height per channel
-counter = 0
-baseline = np.zeros(64)
-prevsignal = np.zeros(len(fbp.chanlist))
 while running:
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
@@ -36,33 +74,15 @@ while running:
         elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
             running = False
 
-    # Get EEG data from LSL
-    eeg_data = lsl.readdata()
+    # Get EEG data from LSL or from the run
+    if args.shm:
+        eeg_data = readtap()
+    else:
+        eeg_data = lsl.readdata()
         
     if eeg_data is not None and len(eeg_data)>0:
-        eeg_data = eeg_data*scale
-        # Clear the old drawings
-        if counter + eeg_data.shape[1] > screen_width: # we need two rectangles
-            pygame.draw.rect(screen,(0,0,0),pygame.Rect(min(counter,screen_width-1),1,screen_width - counter,screen_height))
-            pygame.draw.rect(screen,(0,0,0),pygame.Rect(1,1,(counter+eeg_data.shape[1])%screen_width,screen_height))
-        else:
-            pygame.draw.rect(screen,(0,0,0),pygame.Rect(counter+1,1,eeg_data.shape[1],screen_height))
-        # Display EEG signals        
-        for i in np.arange(eeg_data.shape[1]):
-            for ch in np.arange(eeg_data.shape[0]):
-                signal = eeg_data[ch,i]
-                if counter < screen_width:
-                    if counter==0:
-                        baseline[ch]=(ch * channel_height + channel_height // 2)-int(signal)
-                    # Scale the signal for display within the assigned channel area
-                    x1 = counter
-                    y1 = int(prevsignal[ch] + baseline[ch])
-                    x2 = counter +1
-                    y2 = int(signal + baseline[ch])
-                    pygame.draw.line(screen, (0, 255, 0), (x1, y1), (x2, y2), 1)
-            counter = (counter+1) % screen_width
-            prevsignal = signal = eeg_data[:,i]
-    pygame.display.update()
-    clock.tick(4)  # Control the update rate of the signal
+        # only the columns that changed are sent to the display
+        pygame.display.update(display.draw(eeg_data))
+    clock.tick(60)  # Control the update rate of the signal
 
 pygame.quit()
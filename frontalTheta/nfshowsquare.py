@@ -1,25 +1,47 @@
 import pygame
 import nfcomm
+import argparse
+from pylsl import local_clock
+
+parser = argparse.ArgumentParser(description="Show the Feedback Square")
+parser.add_argument('-p', '--port', type=int, help='Feedback port of the run (reports go to port+1, default 1977)')
+args = parser.parse_args()
 
 # Initialize Pygame
 pygame.init()
 
 total_width, total_height = 900, 900
-screen = pygame.display.set_mode((total_width, total_height))
+try: # wait for the vertical blank, so a frame is shown when update returns
+    screen = pygame.display.set_mode((total_width, total_height), pygame.SCALED, vsync=1)
+except pygame.error:
+    screen = pygame.display.set_mode((total_width, total_height))
 pygame.display.set_caption("Colored Square Feedback")
+square = pygame.Rect( 100, 100, total_width-200, total_height-200)
+refreshrate = pygame.display.get_current_refresh_rate() if hasattr(pygame.display,'get_current_refresh_rate') else 0
+frametime = 1/refreshrate if refreshrate>0 else 1/60
 running = True
 listener =  nfcomm.udpfeedback()
+if args.port:
+    listener.UDP_PORT = args.port
+    listener.REPORT_PORT = args.port+1
 listener.connect()
 listener.bindListener()
 
+color = None
 while running:
     for event in pygame.event.get():
         if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
             running = False
-    col = listener.recievemsg()
-    if len( col)==3:
-        pygame.draw.rect(screen, (col[0], col[1],col[2]), pygame.Rect( 100, 100, total_width-200, total_height-200))
-        pygame.display.flip()
+    # sleep until a packet arrives (at most a frame, to keep the window responsive)
+    listener.wait(frametime)
+    latest = listener.receivelatest() # older packets are outdated
+    if latest is not None:
+        if latest[2] != color: # only redraw if the color changed
+            color = latest[2]
+            screen.fill(color, square)
+            pygame.display.update(square)
+        # tell the run when the packet was shown
+        listener.sendreport(latest, local_clock())
         
 pygame.quit()
-listener.close()
\ No newline at end of file
+listener.close()
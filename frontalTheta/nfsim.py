@@ -0,0 +1,228 @@
+import numpy as np
+import scipy.signal
+import argparse, time
+from pylsl import local_clock
+
+# simulated eeg for tests and benchmarks without hardware, gui or keyboard
+# the signal only depends on the seed and the scenario: frontal theta whose amplitude
+# rises and falls slowly, background noise, line noise and optional blinks and emg bursts
+# the data is delivered in packets like an amplifier would send them, packets can arrive
+# late (jitter) or get lost; simreader has the interface of nfcomm.lslreader and runs
+# inside nfrun (--source sim), main() sends the same data via lsl
+
+# spatial profile of each source, channels not listed get the default weight
+thetaweights = {'Fz':1.0,'Fpz':0.6,'F7':0.5,'F8':0.5,'Cz':0.7,'default':0.2}
+blinkweights = {'Fpz':1.0,'F7':0.6,'F8':0.6,'Fz':0.4,'Cz':0.15,'default':0.05}
+emgweights = {'F7':1.0,'F8':1.0,'T7':1.0,'T8':1.0,'P7':0.8,'P8':0.8,'default':0.1}
+
+# settings of simulator (signal) and simreader (packet, jitter in sec and loss probability)
+scenarios = {
+    'clean':     {},
+    'artifacts': {'blinkrate':0.3,'emgrate':0.05},
+    'jitter':    {'blinkrate':0.3,'emgrate':0.05,'jitter':0.02},
+    'lossy':     {'blinkrate':0.3,'emgrate':0.05,'jitter':0.02,'loss':0.01},
+}
+
+def weights(chanlist,profile:dict):
+    return np.array([profile.get(chan,profile['default']) for chan in chanlist])
+
+class simulator:
+    # multichannel eeg in uV, generated in blocks of blocksize samples
+    # phase accumulators, filter states and the tails of artifacts carry over between
+    # blocks, so the data is continuous and the same for the same seed
+    def __init__(self,chanlist,srate:int=500,seed:int=0,theta:float=6.0,thetaamp:float=10.0,
+                 thetadepth:float=0.8,modperiod:float=30.0,background:float=10.0,linenoise:float=2.0,
+                 blinkrate:float=0.0,blinkamp:float=150.0,blinklength:float=0.3,
+                 emgrate:float=0.0,emgamp:float=20.0,emglength:float=1.0,blocksize:int=0):
+        self.chanlist = list(chanlist)
+        self.nchan = len(chanlist)
+        self.srate = srate
+        self.rng = np.random.default_rng(seed)
+        self.theta = theta
+        self.thetaamp = thetaamp
+        self.thetadepth = thetadepth # relative depth of the slow amplitude modulation
+        self.modperiod = modperiod # in sec
+        self.linenoise = linenoise
+        self.blinkrate = blinkrate # per sec
+        self.blinkamp = blinkamp
+        self.emgrate = emgrate # per sec
+        self.emgamp = emgamp
+        self.blinksamps = max(1,round(blinklength*srate))
+        self.emgsamps = max(1,round(emglength*srate))
+        self.blocksize = blocksize or srate
+        self.thetaweights = weights(chanlist,thetaweights)
+        self.blinkweights = weights(chanlist,blinkweights)
+        self.emgweights = weights(chanlist,emgweights)
+        # background noise: first order lowpass of white noise (more power at low frequencies)
+        self.ar = 0.95
+        self.noisescale = background*np.sqrt(1-self.ar**2)
+        self.zi = np.zeros((self.nchan,1))
+        self.phase = np.zeros(2) # theta and line noise
+        self.carry = np.zeros((self.nchan,0)) # artifacts that reach into the next block
+        self.count = 0 # samples generated
+        self.block = np.zeros((self.nchan,0))
+        self.pos = 0 # samples of self.block already read
+
+    def generate(self,nsamp:int):
+        # channels x nsamp of new data
+        t = (self.count+np.arange(nsamp))/self.srate
+        data, self.zi = scipy.signal.lfilter([self.noisescale],[1,-self.ar],self.rng.standard_normal((self.nchan,nsamp)),axis=1,zi=self.zi)
+        steps = 2*np.pi*np.outer([self.theta,50.0],np.arange(nsamp))/self.srate
+        waves = np.sin(self.phase[:,np.newaxis]+steps)
+        self.phase = np.mod(self.phase+2*np.pi*np.array([self.theta,50.0])*nsamp/self.srate,2*np.pi)
+        envelope = self.thetaamp*(1-self.thetadepth/2+self.thetadepth/2*np.sin(2*np.pi*t/self.modperiod))
+        data += np.outer(self.thetaweights,envelope*waves[0])
+        data += self.linenoise*waves[1]
+        # artifacts start within the block and are added to the following blocks as well
+        artifacts = np.zeros((self.nchan,nsamp+max(self.blinksamps,self.emgsamps)))
+        artifacts[:,:self.carry.shape[1]] += self.carry
+        for start in self.rng.integers(0,nsamp,self.rng.poisson(self.blinkrate*nsamp/self.srate)):
+            shape = np.hanning(self.blinksamps)*self.blinkamp*self.rng.uniform(0.7,1.3)
+            artifacts[:,start:start+self.blinksamps] += np.outer(self.blinkweights,shape)
+        for start in self.rng.integers(0,nsamp,self.rng.poisson(self.emgrate*nsamp/self.srate)):
+            # broadband (differentiated white noise) within a smooth envelope
+            burst = np.diff(self.rng.standard_normal((self.nchan,self.emgsamps+1)),axis=1)/np.sqrt(2)
+            artifacts[:,start:start+self.emgsamps] += self.emgamp*self.emgweights[:,np.newaxis]*burst*np.hanning(self.emgsamps)
+        data += artifacts[:,:nsamp]
+        self.carry = artifacts[:,nsamp:]
+        self.count += nsamp
+        return data
+
+    def read(self,nsamp:int):
+        # the next nsamp samples (channels x samples), always generated in blocks of
+        # blocksize, such that the data does not depend on how it is read
+        out = np.zeros((self.nchan,nsamp))
+        k = 0
+        while k < nsamp:
+            if self.pos >= self.block.shape[1]:
+                self.block = self.generate(self.blocksize)
+                self.pos = 0
+            n = min(nsamp-k, self.block.shape[1]-self.pos)
+            out[:,k:k+n] = self.block[:,self.pos:self.pos+n]
+            self.pos += n
+            k += n
+        return out
+
+class simreader:
+    # simulated acquisition with the interface of nfcomm.lslreader (connect, readinto, readdata)
+    # speed 1 delivers the packets in real time, speed 0 as fast as they are read
+    # timestamps are on the lsl clock: the time a sample exists in the (sped up) simulation,
+    # or with speed 0 the time its packet is delivered, so latencies never run negative
+    def __init__(self,chanlist,maxchunk=1024,timeout=0.1,srate=500,scenario:str='clean',seed:int=0,speed:float=1.0):
+        if scenario not in scenarios:
+            raise ValueError("unknown scenario %s (%s)" % (scenario,", ".join(scenarios)))
+        settings = dict(scenarios[scenario])
+        self.chanlist = chanlist
+        self.neegchan = len(chanlist)
+        self.maxchunk = maxchunk # max number of samples per readinto
+        self.timeout = timeout # in sec, readinto waits this long for new samples
+        self.srate = srate
+        self.speed = speed
+        self.packet = min(maxchunk, settings.pop('packet', max(1,round(srate/50)))) # samples per packet
+        self.jitter = settings.pop('jitter',0.0)
+        self.loss = settings.pop('loss',0.0)
+        self.sim = simulator(chanlist,srate,seed,**settings)
+        self.rng = np.random.default_rng([seed,1]) # transport, independent of the signal
+        self.buffer = np.zeros((maxchunk,self.neegchan))
+        self.timestamps = np.zeros(maxchunk)
+        self.starttime = 0 # lsl time of sample 0
+        self.next = None # start sample, arrival time and loss of the next packet
+        self.arrival = 0 # arrival time of the last packet (packets stay in order)
+        self.lost = 0 # samples lost
+        self.delivered = 0 # samples delivered
+
+    def connect(self):
+        print("Simulating %d channels at %d Hz." % (self.neegchan,self.srate))
+        self.starttime = local_clock()
+        self.arrival = self.starttime
+        return 0
+
+    def now(self):
+        # time of the simulation on the lsl clock
+        if self.speed <= 0:
+            return np.inf
+        return self.starttime + (local_clock()-self.starttime)*self.speed
+
+    def nextpacket(self):
+        start = self.sim.count - self.sim.block.shape[1] + self.sim.pos # first sample not read yet
+        arrival = self.starttime + (start+self.packet)/self.srate
+        if self.jitter > 0:
+            arrival += abs(self.rng.normal(0,self.jitter))
+        self.arrival = max(self.arrival,arrival)
+        return start, self.arrival, self.rng.random() < self.loss
+
+    def readinto(self):
+        # waits up to self.timeout for packets and returns a channels x samples view of the
+        # preallocated buffer (only valid until the next call) and the timestamps
+        nsamp = 0
+        deadline = local_clock()+self.timeout
+        while nsamp+self.packet <= self.maxchunk:
+            if self.next is None:
+                self.next = self.nextpacket()
+            start, arrival, lost = self.next
+            wait = (arrival-self.now())/self.speed if self.speed > 0 else 0
+            if wait > 0:
+                remaining = deadline-local_clock()
+                if nsamp > 0 or remaining <= 0: # only wait for the first packet
+                    break
+                time.sleep(min(wait,remaining))
+                continue
+            self.next = None
+            data = self.sim.read(self.packet)
+            if lost:
+                self.lost += self.packet
+                continue
+            self.buffer[nsamp:nsamp+self.packet,:] = data.T
+            if self.speed > 0:
+                self.timestamps[nsamp:nsamp+self.packet] = self.starttime + (start+np.arange(self.packet))/self.srate/self.speed
+            else:
+                self.timestamps[nsamp:nsamp+self.packet] = local_clock()
+            nsamp += self.packet
+        self.delivered += nsamp
+        return self.buffer[:nsamp,:].T, self.timestamps[:nsamp].copy()
+
+    def readdata(self):
+        chunk, _ = self.readinto()
+        return np.array(chunk)
+
+    def close(self):
+        if self.lost > 0:
+            print("Simulation lost %d of %d samples." % (self.lost,self.lost+self.delivered))
+
+def main():
+    # sends the simulated data as an lsl stream (for nfrun, nfshowsignals, ... in other processes)
+    from pylsl import StreamInfo, StreamOutlet
+    import nfprocess
+    parser = argparse.ArgumentParser(description="Send simulated EEG via LSL")
+    parser.add_argument('-f', '--samplingrate', type=int, default=250, help='Sampling Frequency')
+    parser.add_argument('-n', '--nchan', type=int, default=0, help='Number of channels (default: channels of the protocol)')
+    parser.add_argument('-s', '--scenario', type=str, default='clean', help='Scenario (%s)' % ", ".join(scenarios))
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the simulated data')
+    parser.add_argument('--speed', type=float, default=1.0, help='1 real time, 0 as fast as possible')
+    parser.add_argument('-d', '--duration', type=float, default=0, help='Stop after this many sec of data (0 runs until Ctrl+C)')
+    parser.add_argument('--name', type=str, default='nfsim', help='Name of the lsl stream')
+    args = parser.parse_args()
+
+    chanlist = nfprocess.frontaltheta().chanlist
+    if args.nchan > 0:
+        chanlist = (chanlist + ["E%d" % (k+1) for k in range(len(chanlist),args.nchan)])[:args.nchan]
+    reader = simreader(chanlist,1024,0.1,args.samplingrate,args.scenario,args.seed,args.speed)
+    info = StreamInfo(args.name, "EEG", len(chanlist), args.samplingrate, "float32", "nfsim%d" % args.seed)
+    channels = info.desc().append_child("channels")
+    for chan in chanlist:
+        channels.append_child("channel").append_child_value("label",chan)
+    outlet = StreamOutlet(info)
+    reader.connect()
+    print("Now transmitting data...")
+    try:
+        while args.duration <= 0 or reader.delivered+reader.lost < args.duration*args.samplingrate:
+            chunk, timestamps = reader.readinto()
+            if len(timestamps) > 0:
+                # one timestamp per sample, lost packets leave gaps
+                outlet.push_chunk(np.ascontiguousarray(chunk.T,dtype=np.float32), timestamps.tolist())
+    except KeyboardInterrupt:
+        pass
+    reader.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import nfdata
+import nfprocess
+import nfreplay
+import numpy as np
+import argparse
+import itertools, csv, os, time, tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+# grid search of protocol parameters over recorded sessions
+# configurations that only differ after the filter stage share the filtered data:
+# every session is filtered once per filter setting (causal, as online) into a
+# temporary recording (nfdata.sessionrecorder), the configurations of that setting
+# are replayed on the memory-mapped recording, possibly split over several tasks
+
+filterparams = ['stopband','highpass'] # parameters that change the filtered data
+columns = ['session','windowwidth','fbrefresh','targetfrequencies','stopband','highpass',
+           'edgewiden','edgenarrow','maxstep','nevents','meanamplitude','meanfeedback',
+           'stdfeedback','fractionlow','fractionhigh','meanloweredge','meanupperedge']
+
+def configure(fbp, config:dict):
+    for key,value in config.items():
+        if key in ('stopband','targetfrequencies'):
+            value = np.array(value,dtype=float)
+        setattr(fbp,key,value)
+    return fbp
+
+def summarize(session:str, config:dict, outcome:nfdata.fbdata):
+    feedback = np.array(outcome.feedbackvalue)
+    row = dict(session=os.path.basename(session))
+    defaults = nfprocess.frontaltheta()
+    for key in columns[1:9]:
+        value = config.get(key,getattr(defaults,key))
+        row[key] = " ".join(str(v) for v in np.atleast_1d(value))
+    row['nevents'] = len(feedback)
+    if len(feedback)>0:
+        row['meanamplitude'] = np.mean(outcome.amplitude)
+        row['meanfeedback'] = np.mean(feedback)
+        row['stdfeedback'] = np.std(feedback)
+        row['fractionlow'] = np.mean(feedback<=0)
+        row['fractionhigh'] = np.mean(feedback>=1)
+        row['meanloweredge'] = np.mean(outcome.loweredge)
+        row['meanupperedge'] = np.mean(outcome.upperedge)
+    return row
+
+def prefilter(session:str, filterconfig:dict, path:str):
+    # filter the session with one filter setting and record the result in path
+    fbp = configure(nfprocess.frontaltheta(), filterconfig)
+    eeg = nfdata.io.loadsession(session, fbp.chanlist)
+    filters = nfprocess.filterbank(eeg.nchan, eeg.srate, fbp.filterstages())
+    recorder = nfdata.sessionrecorder(path, fbp.chanlist, eeg.srate)
+    recorder.addeeg(filters.filter(eeg.recorded()))
+    recorder.finalize()
+    return path
+
+def sweepsession(session:str, path:str, configs:list, model:dict):
+    # replay the configurations on the prefiltered session in path
+    filtered = nfdata.sessionreader(path)
+    rows = list()
+    for config in configs:
+        fbp = configure(nfprocess.frontaltheta(), config)
+        outcome = nfreplay.replay(filtered, fbp, model, 'prefiltered')
+        rows.append(summarize(session, config, outcome))
+    filtered.close()
+    return rows
+
+def makegrid(args):
+    # all combinations of the given parameter values
+    grid = dict()
+    for key in ['windowwidth','fbrefresh','edgewiden','edgenarrow','maxstep','highpass']:
+        if getattr(args,key):
+            grid[key] = getattr(args,key)
+    for key in ['targetfrequencies','stopband']:
+        if getattr(args,key):
+            grid[key] = [[float(v) for v in value.split(',')] for value in getattr(args,key)]
+    keys = list(grid.keys())
+    return [dict(zip(keys,values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep protocol parameters over recorded sessions")
+    parser.add_argument('sessions', type=str, nargs='+', help='Recorded runs (.mat) or BrainVision files (.vhdr)')
+    parser.add_argument('-m', '--model', type=str, help='Model file (default model if not given)')
+    parser.add_argument('-o', '--output', type=str, default='sweep.csv', help='Results table (csv)')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of processes (default all cores)')
+    parser.add_argument('--windowwidth', type=float, nargs='+', help='Window widths in sec')
+    parser.add_argument('--fbrefresh', type=float, nargs='+', help='Feedback intervals in sec')
+    parser.add_argument('--targetfrequencies', type=str, nargs='+', help='Comma separated target frequencies, e.g. 4,5,6')
+    parser.add_argument('--stopband', type=str, nargs='+', help='Comma separated notch band, e.g. 42.5,57.5')
+    parser.add_argument('--highpass', type=float, nargs='+', help='Highpass cutoffs in Hz')
+    parser.add_argument('--edgewiden', type=float, nargs='+', help='Edge widening divisors (default 30)')
+    parser.add_argument('--edgenarrow', type=float, nargs='+', help='Edge narrowing divisors (default 100)')
+    parser.add_argument('--maxstep', type=float, nargs='+', help='Max feedback change per event (default 0.05)')
+    args = parser.parse_args()
+
+    if args.model:
+        model = nfdata.io.loadmodel(args.model)
+    else:
+        model = {'artifactthresh':1000,'badchanthresh':1000,'loweredge':-1,'upperedge':-1}
+    configs = makegrid(args)
+
+    # group the configurations by their filter settings
+    groups = dict()
+    for config in configs:
+        key = tuple((p,tuple(np.atleast_1d(config[p]))) for p in filterparams if p in config)
+        groups.setdefault(key,list()).append(config)
+
+    jobs = args.jobs if args.jobs else os.cpu_count()
+    # split the groups further if there are fewer tasks than processes,
+    # the parts of a group all read the same prefiltered recording
+    nsplit = max(1,jobs//(len(args.sessions)*len(groups)))
+    print('%d configurations, %d sessions, %d filter settings on %d processes'
+          % (len(configs), len(args.sessions), len(groups), jobs))
+    starttime = time.time()
+    with tempfile.TemporaryDirectory() as tmpdir, ProcessPoolExecutor(max_workers=jobs) as pool:
+        filtertasks = list()
+        for n,session in enumerate(args.sessions):
+            for k,key in enumerate(groups):
+                filterconfig = {p:np.array(v) for p,v in key}
+                filtertasks.append((session,filterconfig,os.path.join(tmpdir,'session%d_filter%d.nfs' % (n,k))))
+        paths = list(pool.map(prefilter,*zip(*filtertasks)))
+        tasks = list()
+        for (session,_,_),path,group in zip(filtertasks,paths,itertools.cycle(groups.values())):
+            for k in range(min(nsplit,len(group))):
+                tasks.append((session,path,group[k::nsplit],model))
+        results = pool.map(sweepsession,*zip(*tasks))
+        with open(args.output,'w',newline='') as f:
+            writer = csv.DictWriter(f,fieldnames=columns)
+            writer.writeheader()
+            for rows in results:
+                writer.writerows(rows)
+    print('done in %.1f s, results in %s' % (time.time()-starttime, args.output))
+
+if __name__ == "__main__":
+    main()
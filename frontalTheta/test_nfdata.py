@@ -0,0 +1,54 @@
+import os
+import threading
+import pytest
+import numpy as np
+import nfdata
+
+def test_recorded_chunk_survives_reused_buffer(tmp_path):
+    # readers (lslreader, f1reader, simreader) return views of one buffer that is
+    # overwritten by the next chunk, the recording must keep what was handed over
+    buffer = np.zeros((32,4))
+    recorder = nfdata.sessionrecorder(str(tmp_path/'run.nfs'),['a','b','c','d'],500)
+    expected = list()
+    for k in range(200):
+        buffer[:] = k + np.arange(buffer.size).reshape(buffer.shape)
+        chunk = buffer[:16,:].T # channels x samples view, C-contiguous after .T
+        recorder.addeeg(chunk,np.arange(16)+16*k)
+        expected.append(np.array(chunk))
+    buffer[:] = -1
+    recorder.finalize()
+    reader = nfdata.sessionreader(str(tmp_path/'run.nfs'))
+    assert np.array_equal(np.array(reader.eegsignals),np.hstack(expected))
+    reader.close()
+
+def test_writer_error_does_not_block_the_run(tmp_path):
+    # a failing write (here a closed file, on a run e.g. a full disk) stops the recording,
+    # the run can go on handing over data and finalize reports the error
+    recorder = nfdata.sessionrecorder(str(tmp_path/'run.nfs'),['a','b'],500,maxqueue=2)
+    recorder.addeeg(np.ones((2,10)))
+    recorder.flush()
+    recorder.files['eeg'].close()
+    feeder = threading.Thread(target=lambda: [recorder.addeeg(np.ones((2,10))) for k in range(50)])
+    feeder.start()
+    feeder.join(5)
+    assert not feeder.is_alive()
+    with pytest.raises(ValueError):
+        recorder.finalize()
+    reader = nfdata.sessionreader(str(tmp_path/'run.nfs'))
+    assert reader.state == 'failed' and reader.sampcount == 10
+    reader.close()
+
+def test_shmtap_counts_every_sample_of_a_large_chunk():
+    # a chunk larger than the ring advances the sample count by its full length,
+    # so viewers see the gap, and the ring holds the end of the chunk
+    tap = nfdata.shmtap('test_nfdata_tap%d' % os.getpid(),2,500,100)
+    try:
+        data = np.arange(500.0)*np.ones((2,1))
+        tap.write(data[:,:30],np.arange(30.0))
+        tap.write(data[:,30:],np.arange(30.0,500.0))
+        assert tap.raw.sampcount == 500
+        start, window = tap.raw.latest(0)
+        assert start == 401 and np.array_equal(window,data[:,401:])
+        assert np.array_equal(tap.raw.timewindow(401,99),np.arange(401.0,500.0))
+    finally:
+        tap.close()
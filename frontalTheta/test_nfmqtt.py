@@ -0,0 +1,40 @@
+import json
+import threading
+import numpy as np
+import nfmqtt
+
+def message(beg, end, nchan=9):
+    # data/samples payload as the F1 sends it, sample s of channel c has the value 100*s+c
+    samples = 100*np.arange(beg,end)[:,np.newaxis] + np.arange(nchan)
+    return np.array([beg,end],dtype=np.uint32).tobytes() + samples.astype(np.int32).tobytes()
+
+def test_f1reader_through_fakebroker():
+    broker = nfmqtt.fakebroker()
+    reader = nfmqtt.f1reader(['Fpz','Fz','F7','F8','Cz','P7','P8','Oz'],maxchunk=16,timeout=0.01,
+                             client=broker.client(),srate=500)
+    device = broker.client() # the F1: sends its info and receives the start command
+    commands = list()
+    device.on_message = lambda client,userdata,msg: commands.append(msg)
+    device.connect()
+    device.subscribe("action/#")
+    threading.Timer(0.05,device.publish,(nfmqtt.topic_info,json.dumps({'scale_to_uV':0.5}))).start()
+    assert reader.connect(timeout=5) == 0
+    assert commands[0].topic == nfmqtt.topic_action_start
+    assert json.loads(commands[0].payload)['sampling_rate'] == 500
+
+    for beg,end in [(0,10),(10,20),(10,20),(15,30),(40,50)]: # duplicate, overlap, gap
+        device.publish(nfmqtt.topic_samples,message(beg,end))
+    chunks, timestamps = list(), list()
+    while True:
+        chunk, times = reader.readinto()
+        if chunk.shape[1]==0:
+            break
+        assert chunk.shape[0] == 8 and chunk.shape[1] <= 16 and len(times) == chunk.shape[1]
+        chunks.append(np.array(chunk))
+        timestamps.append(np.array(times))
+    positions = np.r_[0:30,40:50]
+    assert np.array_equal(np.hstack(chunks), 0.5*(100*positions+np.arange(8)[:,np.newaxis]))
+    assert np.allclose(np.diff(np.hstack(timestamps)), np.diff(positions)/500)
+    assert reader.duplicates == 15 and reader.gaps == 10
+    reader.close()
+    assert commands[-1].topic == nfmqtt.topic_action_stop